@@ -0,0 +1,376 @@
+# Copyright 2015 Zuercher Hochschule fuer Angewandte Wissenschaften
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''
+Local stand-in for the SDC SAPI, VMAPI, NAPI, PAPI and IMGAPI
+
+All APIs are served from one HTTP server, SAPI resolves every service to it. Each request can be delayed by a
+configurable latency and VM state transitions (provisioning -> running -> stopped -> destroyed) happen after
+configurable times or follow a script.
+'''
+
+__author__ = 'ernm'
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import Counter
+from urlparse import urlparse, parse_qs
+import json
+import re
+import threading
+import time
+import uuid
+
+UUID_PATTERN = '[0-9a-fA-F-]{36}'
+
+# seconds a VM needs for each transition
+DEFAULT_TRANSITION_TIMES = {'provision': 1.0, 'stop': 0.5, 'start': 0.5, 'destroy': 0.5, 'import': 2.0}
+
+EXTERNAL_NETWORK_UUID = 'f3d68d27-e311-491a-9c7f-d2a8d386e6e6'
+
+
+class FakeSDC(object):
+    '''
+    state of the fake datacenter
+    '''
+
+    def __init__(self, latency=0.0, transition_times=None):
+        self.latency = latency
+        self.transition_times = dict(DEFAULT_TRANSITION_TIMES)
+        self.transition_times.update(transition_times or {})
+        self.address = None
+        self.vms = {}
+        self.networks = {}
+        self.packages = {}
+        self.images = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.networks[EXTERNAL_NETWORK_UUID] = {'uuid': EXTERNAL_NETWORK_UUID, 'name': 'external',
+                                                'subnet': '192.168.0.0/16', 'vlan_id': 1, 'nic_tag': 'external',
+                                                'owner_uuids': []}
+
+    def add_package(self, package_uuid, name='fake'):
+        self.packages[package_uuid] = {'uuid': package_uuid, 'name': name, 'quota': 10240, 'max_physical_memory': 1024}
+
+    def add_image(self, image_uuid, name='fake', os='smartos', active_at=0):
+        self.images[image_uuid] = {'uuid': image_uuid, 'name': name, 'os': os, '_active_at': active_at}
+
+    def import_image(self, image_uuid, source):
+        '''
+        imports an image, it becomes active after the import transition time
+        '''
+        with self.lock:
+            if image_uuid not in self.images:
+                self.add_image(image_uuid, name='imported from %s' % source,
+                               active_at=time.time() + self.transition_times['import'])
+        return {'image_uuid': image_uuid, 'job_uuid': str(uuid.uuid4())}
+
+    def image_record(self, image):
+        record = dict((k, v) for k, v in image.items() if not k.startswith('_'))
+        record['state'] = 'active' if image['_active_at'] <= time.time() else 'importing'
+        return record
+
+    def image_missing_for(self, image_uuid):
+        '''
+        seconds until an image is active, the import time if it has to be downloaded first
+        '''
+        image = self.images.get(image_uuid)
+        if image is None:
+            return self.transition_times['import']
+        return max(0, image['_active_at'] - time.time())
+
+    def count(self, method, route):
+        with self.lock:
+            self.calls[(method, route)] += 1
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def schedule(self, vm_uuid, transitions):
+        '''
+        scripts the next states of a VM
+        :param vm_uuid: uuid of the VM
+        :param transitions: list of (seconds from now, state) tuples
+        '''
+        now = time.time()
+        with self.lock:
+            vm = self.vms[vm_uuid]
+            vm['_timeline'] = [entry for entry in vm['_timeline'] if entry[0] <= now] + \
+                [(now + delay, state) for delay, state in transitions]
+
+    def _transition(self, vm_uuid, transient_state, final_state, duration):
+        self.schedule(vm_uuid, [(0, transient_state), (duration, final_state)])
+
+    def vm_state(self, vm):
+        now = time.time()
+        state = None
+        for at, timeline_state in vm['_timeline']:
+            if at <= now:
+                state = timeline_state
+        return state
+
+    def vm_record(self, vm):
+        record = dict((k, v) for k, v in vm.items() if not k.startswith('_'))
+        record['state'] = self.vm_state(vm)
+        return record
+
+    def create_vm(self, params):
+        vm_uuid = str(uuid.uuid4())
+        nics = []
+        for index, network in enumerate(params.get('networks') or []):
+            network_uuid = network.get('uuid') if isinstance(network, dict) else network
+            nic_tag = self.networks.get(network_uuid, {}).get('nic_tag', 'external')
+            nics.append({'ip': '10.%i.%i.%i' % (len(self.vms) // 65536 % 256, len(self.vms) // 256 % 256,
+                                                len(self.vms) % 256),
+                         'mac': '90:b8:d0:%02x:%02x:%02x' % (len(self.vms) // 65536 % 256,
+                                                             len(self.vms) // 256 % 256, index),
+                         'nic_tag': nic_tag,
+                         'network_uuid': network_uuid,
+                         'primary': index == 0})
+        with self.lock:
+            self.vms[vm_uuid] = {'uuid': vm_uuid,
+                                 'brand': params.get('brand'),
+                                 'alias': params.get('alias'),
+                                 'owner_uuid': params.get('owner_uuid'),
+                                 'billing_id': params.get('billing_id'),
+                                 'image_uuid': params.get('image_uuid'),
+                                 'nics': nics,
+                                 'customer_metadata': dict(params.get('customer_metadata') or {}),
+                                 '_timeline': []}
+        # every provisioning job downloads an image that is not in IMGAPI yet
+        self._transition(vm_uuid, 'provisioning', 'running',
+                         self.transition_times['provision'] + self.image_missing_for(params.get('image_uuid')))
+        return {'vm_uuid': vm_uuid, 'job_uuid': str(uuid.uuid4())}
+
+    def vm_action(self, vm_uuid, action):
+        if action == 'stop':
+            self._transition(vm_uuid, 'stopping', 'stopped', self.transition_times['stop'])
+        elif action == 'start':
+            self._transition(vm_uuid, 'stopped', 'running', self.transition_times['start'])
+        elif action == 'destroy':
+            self._transition(vm_uuid, self.vm_state(self.vms[vm_uuid]), 'destroyed', self.transition_times['destroy'])
+        return {'vm_uuid': vm_uuid, 'job_uuid': str(uuid.uuid4())}
+
+    def create_network(self, params):
+        network = dict(params)
+        network['uuid'] = str(uuid.uuid4())
+        with self.lock:
+            self.networks[network['uuid']] = network
+        return network
+
+
+class FakeSDCHandler(BaseHTTPRequestHandler):
+
+    # keep-alive, so the benchmark sees the effect of connection reuse
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, Nagle would delay every response by the delayed ACK timeout
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def sdc(self):
+        return self.server.sdc
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        path = url.path
+        route = re.sub(UUID_PATTERN, ':uuid', path)
+        self.sdc.count(method, route)
+        if self.sdc.latency:
+            time.sleep(self.sdc.latency)
+
+        handler = getattr(self, 'handle_%s' % method.lower(), None)
+        result = handler(route, path, query) if handler else None
+        if result is None:
+            self._reply({'code': 'ResourceNotFound', 'message': '%s %s not found' % (method, path)}, 404)
+        else:
+            self._reply(*result)
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    def _vm(self, path):
+        return self.sdc.vms.get(path.split('/')[2])
+
+    def handle_get(self, route, path, query):
+        sdc = self.sdc
+        if route == '/services':
+            return [{'uuid': 'service-%s' % query.get('name'), 'name': query.get('name')}],
+        if route == '/instances':
+            return [{'uuid': str(uuid.uuid4()), 'metadata': {'ADMIN_IP': sdc.address}}],
+        if route == '/ping':
+            return {'status': 'OK'},
+        if route == '/vms':
+            vms = sdc.vms.values()
+            if query.get('uuids'):
+                vms = [sdc.vms[vm_uuid] for vm_uuid in query['uuids'].split(',') if vm_uuid in sdc.vms]
+            records = [sdc.vm_record(vm) for vm in vms]
+            for field in ('brand', 'owner_uuid', 'state', 'alias'):
+                if query.get(field):
+                    records = [record for record in records if record.get(field) == query[field]]
+            if query.get('fields'):
+                fields = query['fields'].split(',')
+                records = [dict((field, record[field]) for field in fields if field in record) for record in records]
+            return records,
+        if route == '/vms/:uuid':
+            vm = self._vm(path)
+            return (sdc.vm_record(vm),) if vm else None
+        if route == '/vms/:uuid/customer_metadata':
+            vm = self._vm(path)
+            return (vm['customer_metadata'],) if vm else None
+        if route == '/statuses':
+            uuids = (query.get('uuids') or '').split(',')
+            return dict((vm_uuid, sdc.vm_state(sdc.vms[vm_uuid])) for vm_uuid in uuids if vm_uuid in sdc.vms),
+        if route == '/networks':
+            return sdc.networks.values(),
+        if route == '/networks/:uuid':
+            network = sdc.networks.get(path.split('/')[2])
+            return (network,) if network else None
+        if route == '/nics':
+            nics = [dict(nic, belongs_to_uuid=vm['uuid']) for vm in sdc.vms.values()
+                    if sdc.vm_state(vm) != 'destroyed' for nic in vm['nics']]
+            if query.get('network_uuid'):
+                nics = [nic for nic in nics if nic['network_uuid'] == query['network_uuid']]
+            return nics,
+        if route == '/packages':
+            return sdc.packages.values(),
+        if route == '/packages/:uuid':
+            package = sdc.packages.get(path.split('/')[2])
+            return (package,) if package else None
+        if route == '/images':
+            return [sdc.image_record(image) for image in sdc.images.values()],
+        if route == '/images/:uuid':
+            image = sdc.images.get(path.split('/')[2])
+            return (sdc.image_record(image),) if image else None
+
+    def handle_post(self, route, path, query):
+        sdc = self.sdc
+        body = self._body()
+        if route == '/vms':
+            return sdc.create_vm(body), 202
+        if route == '/vms/:uuid':
+            vm = self._vm(path)
+            if not vm:
+                return None
+            if query.get('action') == 'update':
+                with sdc.lock:
+                    if 'customer_metadata' in body:
+                        vm['customer_metadata'].update(body.pop('customer_metadata'))
+                    vm.update(body)
+                return {'vm_uuid': vm['uuid'], 'job_uuid': str(uuid.uuid4())}, 202
+            return sdc.vm_action(vm['uuid'], query.get('action')), 202
+        if route == '/vms/:uuid/customer_metadata':
+            vm = self._vm(path)
+            if not vm:
+                return None
+            with sdc.lock:
+                vm['customer_metadata'].update(body)
+            return vm['customer_metadata'],
+        if route == '/networks':
+            return sdc.create_network(body),
+        if route == '/images/:uuid' and query.get('action') == 'import-remote':
+            return sdc.import_image(path.split('/')[2], query.get('source')), 202
+
+    def handle_put(self, route, path, query):
+        sdc = self.sdc
+        body = self._body()
+        if route == '/vms/:uuid/customer_metadata':
+            vm = self._vm(path)
+            if not vm:
+                return None
+            with sdc.lock:
+                vm['customer_metadata'] = dict(body)
+            return vm['customer_metadata'],
+
+    def handle_delete(self, route, path, query):
+        sdc = self.sdc
+        if route == '/vms/:uuid':
+            vm = self._vm(path)
+            return (sdc.vm_action(vm['uuid'], 'destroy'), 202) if vm else None
+        if route == '/networks/:uuid':
+            network_uuid = path.split('/')[2]
+            with sdc.lock:
+                in_use = [vm for vm in sdc.vms.values() if sdc.vm_state(vm) != 'destroyed'
+                          and network_uuid in [nic['network_uuid'] for nic in vm['nics']]]
+                network = None if in_use else sdc.networks.pop(network_uuid, None)
+            if in_use:
+                return {'code': 'InUse', 'message': 'network %s has %i nics' % (network_uuid, len(in_use))}, 409
+            return (None, 204) if network else None
+
+
+class FakeSDCServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, sdc, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), FakeSDCHandler)
+        self.sdc = sdc
+        sdc.address = '%s:%i' % self.server_address
+
+
+def start_fake_sdc(latency=0.0, transition_times=None, host='127.0.0.1', port=0):
+    '''
+    starts a fake SDC in a background thread
+    :return: (FakeSDC, FakeSDCServer), FakeSDC.address is the host:port to use as sapi/vmapi endpoint
+    '''
+    sdc = FakeSDC(latency=latency, transition_times=transition_times)
+    server = FakeSDCServer(sdc, host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return sdc, server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser('fake_sdc.py')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    args = parser.parse_args()
+    fake_sdc = FakeSDC(latency=args.latency)
+    fake_server = FakeSDCServer(fake_sdc, '127.0.0.1', args.port)
+    print 'fake SDC listening on %s' % fake_sdc.address
+    fake_server.serve_forever()
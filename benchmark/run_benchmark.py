@@ -0,0 +1,296 @@
+#!/bin/env python
+# Copyright 2015 Zuercher Hochschule fuer Angewandte Wissenschaften
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''
+Benchmarks the SDC heat plugin against the fake SDC from fake_sdc.py
+
+Drives SDCSmartMachine, SDCKVM, SDCNetwork and SDCSmartNetwork resources through their lifecycle the way the heat
+engine does (one greenthread per resource calling handle_* and polling check_*_complete) and reports API calls,
+wall time and p50/p99 per operation. Needs heat and sdcadmin to be importable.
+'''
+
+__author__ = 'ernm'
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sdc_plugin
+from fake_sdc import start_fake_sdc, EXTERNAL_NETWORK_UUID
+
+OWNER_UUID = '930896af-bf8c-48d4-885c-6573a94b1853'
+PACKAGE_UUID = 'b1abec1a-80e5-ea9e-e091-8f2d67feb252'
+IMAGE_UUID = '62f148f8-6e84-11e4-82c5-efca60348b9f'
+
+CONFIG_TEMPLATE = '''[RESOURCES]
+enable_smartmachine = True
+enable_kvm = True
+enable_network = True
+enable_smart_network = True
+
+[OVERRIDE]
+override_owner = True
+override_owner_uuid = %(owner)s
+override_endpoints = True
+override_sapi_endpoint = %(endpoint)s
+override_vmapi_endpoint = %(endpoint)s
+override_nic_tag = True
+override_nic_tag_name = customer
+real_owner = False
+
+[PREFETCH]
+prefetch_images = %(prefetch)s
+prefetch_source = http://%(endpoint)s
+
+[RATE_LIMIT]
+%(rate_limits)s
+'''
+
+
+class FakeStack(object):
+    def __init__(self, stack_id):
+        self.id = stack_id
+        self.name = 'benchmark-%s' % stack_id
+        self.context = None
+        self.resources = {}
+
+    def values(self):
+        return self.resources.values()
+
+
+class FakeKeypairs(object):
+    def list(self):
+        return []
+
+
+class FakeNova(object):
+    keypairs = FakeKeypairs()
+
+
+class BenchmarkResourceMixin(object):
+    '''
+    replaces the parts of heat.engine.resource.Resource that need a database and a real stack
+    '''
+
+    def __init__(self, name, props, stack):
+        self.name = name
+        self.properties = props
+        self.stack = stack
+        self.context = stack.context
+        self.resource_id = None
+        self._data = {}
+
+    def resource_id_set(self, value):
+        self.resource_id = value
+
+    def data(self):
+        return dict(self._data)
+
+    def data_set(self, key, value, redact=False):
+        self._data[key] = value
+
+    def physical_resource_name(self):
+        return '%s-%s' % (self.stack.name, self.name)
+
+    def nova(self):
+        return FakeNova()
+
+
+def benchmark_class(cls):
+    return type('Benchmark' + cls.__name__, (BenchmarkResourceMixin, cls), {})
+
+
+def machine_properties(index):
+    return {'instance_alias': 'bench-%i' % index,
+            'package': PACKAGE_UUID,
+            'image': IMAGE_UUID,
+            'networks': EXTERNAL_NETWORK_UUID,
+            'user_script': 'touch /test'}
+
+
+def network_properties(index):
+    return {'name': 'bench-net-%i' % index,
+            'subnet': '172.%i.%i.0/24' % (16 + index // 256 % 16, index % 256),
+            'provision_start': '172.%i.%i.10' % (16 + index // 256 % 16, index % 256),
+            'provision_end': '172.%i.%i.250' % (16 + index // 256 % 16, index % 256),
+            'nic_tag': 'customer',
+            'gateway': '',
+            'vlan': 1000 + index,
+            'resolvers': '8.8.8.8',
+            'routes': '0.0.0.0/0:172.16.0.1',
+            'description': 'benchmark network',
+            'mask_bits': 24}
+
+
+RESOURCE_TYPES = {
+    'smartmachine': (sdc_plugin.SDCSmartMachine, machine_properties,
+                     ['validate', 'create', 'suspend', 'resume', 'update', 'delete']),
+    'kvm': (sdc_plugin.SDCKVM, machine_properties, ['validate', 'create', 'suspend', 'resume', 'update', 'delete']),
+    'network': (sdc_plugin.SDCNetwork, network_properties, ['create', 'delete']),
+    'smartnetwork': (sdc_plugin.SDCSmartNetwork, network_properties, ['create', 'delete']),
+}
+
+
+def run_action(res, operation, poll_interval):
+    '''
+    runs one operation the way heat's TaskRunner does
+    :return: seconds until the operation was complete
+    '''
+    started = time.time()
+    if operation == 'validate':
+        res.validate()
+        return time.time() - started
+    if operation == 'update':
+        prop_diff = {res.USER_SCRIPT: 'touch /updated-%f' % started}
+        token = res.handle_update(prop_diff=prop_diff)
+        res.properties.update(prop_diff)
+    else:
+        token = getattr(res, 'handle_%s' % operation)()
+    check = getattr(res, 'check_%s_complete' % operation, None)
+    if check:
+        while not check(token):
+            eventlet.sleep(poll_interval)
+    return time.time() - started
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_benchmark(sdc, resource_type, size, poll_interval, skip_operations=()):
+    cls, properties_for, operations = RESOURCE_TYPES[resource_type]
+    operations = [operation for operation in operations if operation not in skip_operations]
+    stack = FakeStack('stack-%s-%i' % (resource_type, size))
+    resources = [benchmark_class(cls)('%s_%i' % (resource_type, index), properties_for(index), stack)
+                 for index in range(size)]
+    stack.resources = dict((res.name, res) for res in resources)
+    # every run starts with cold plugin caches
+    sdc_plugin.dc_pool.clear()
+
+    results = []
+    for operation in operations:
+        sdc.reset_calls()
+        pool = eventlet.GreenPool(size)
+        started = time.time()
+        durations = list(pool.imap(lambda res: run_action(res, operation, poll_interval), resources))
+        wall = time.time() - started
+        api_calls = sdc.total_calls()
+        results.append({'resource': resource_type,
+                        'size': size,
+                        'operation': operation,
+                        'wall': wall,
+                        'p50': percentile(durations, 0.5),
+                        'p99': percentile(durations, 0.99),
+                        'api_calls': api_calls,
+                        'calls_by_route': dict(('%s %s' % key, count) for key, count in sdc.calls.items())})
+    return results
+
+
+def check_baseline(results, baseline_file, tolerance):
+    '''
+    compares API call counts with a previous --json run
+    :return: list of regressions
+    '''
+    with open(baseline_file) as f:
+        baseline = dict(((r['resource'], r['size'], r['operation']), r['api_calls']) for r in json.load(f))
+    regressions = []
+    for result in results:
+        expected = baseline.get((result['resource'], result['size'], result['operation']))
+        if expected is not None and result['api_calls'] > expected * (1 + tolerance):
+            regressions.append('%(resource)s x%(size)i %(operation)s: %(api_calls)i API calls' % result +
+                               ', baseline %i' % expected)
+    return regressions
+
+
+def configure_plugin(endpoint, prefetch=False, rate_limits=()):
+    config_file = tempfile.NamedTemporaryFile(suffix='.conf', delete=False)
+    config_file.write(CONFIG_TEMPLATE % {'owner': OWNER_UUID, 'endpoint': endpoint, 'prefetch': prefetch,
+                                         'rate_limits': '\n'.join(rate_limits)})
+    config_file.close()
+    sdc_plugin.sdc_config.path = config_file.name
+    sdc_plugin.sdc_config.load()
+
+
+def main():
+    parser = argparse.ArgumentParser('run_benchmark.py')
+    parser.add_argument('--resources', default='smartmachine,kvm,network,smartnetwork',
+                        help='Comma separated resource types: %s.' % ', '.join(sorted(RESOURCE_TYPES)))
+    parser.add_argument('--sizes', default='1,10,100,1000', help='Comma separated stack sizes.')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds the fake SDC adds to every request.')
+    parser.add_argument('--provision-time', type=float, default=1.0, help='Seconds until a new VM is running.')
+    parser.add_argument('--transition-time', type=float, default=0.5,
+                        help='Seconds a VM needs to stop, start or be destroyed.')
+    parser.add_argument('--poll-interval', type=float, default=0.2,
+                        help='Seconds between two check_*_complete calls of a resource.')
+    parser.add_argument('--cold-images', action='store_true',
+                        help='Start without the image in the fake IMGAPI, provisioning jobs then download it first.')
+    parser.add_argument('--prefetch', action='store_true', help='Enable the image prefetch of the plugin.')
+    parser.add_argument('--import-time', type=float, default=2.0, help='Seconds an image download takes.')
+    parser.add_argument('--rate-limit', action='append', default=[],
+                        help='[RATE_LIMIT] option of the plugin config, e.g. "vmapi.create = 5/10/20", repeatable.')
+    parser.add_argument('--json', dest='json_file', help='Write the results to this file.')
+    parser.add_argument('--baseline', help='Fail if API call counts exceed the ones in this --json file.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed relative increase of API calls over the baseline.')
+    args = parser.parse_args()
+
+    sdc, server = start_fake_sdc(latency=args.latency,
+                                 transition_times={'provision': args.provision_time,
+                                                   'stop': args.transition_time,
+                                                   'start': args.transition_time,
+                                                   'destroy': args.transition_time,
+                                                   'import': args.import_time})
+    sdc.add_package(PACKAGE_UUID)
+    if not args.cold_images:
+        sdc.add_image(IMAGE_UUID)
+    configure_plugin(sdc.address, prefetch=args.prefetch, rate_limits=args.rate_limit)
+    # without prefetch the image is not in IMGAPI yet, validation rightly rejects it
+    skip_operations = ['validate'] if args.cold_images and not args.prefetch else []
+
+    results = []
+    print '%-14s %6s %-9s %9s %9s %9s %10s' % ('resource', 'size', 'operation', 'wall[s]', 'p50[s]', 'p99[s]',
+                                              'api calls')
+    for resource_type in args.resources.split(','):
+        for size in [int(size) for size in args.sizes.split(',')]:
+            for result in run_benchmark(sdc, resource_type, size, args.poll_interval, skip_operations):
+                print '%(resource)-14s %(size)6i %(operation)-9s %(wall)9.2f %(p50)9.2f %(p99)9.2f ' \
+                      '%(api_calls)10i' % result
+                results.append(result)
+
+    server.shutdown()
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION: %s' % regression
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
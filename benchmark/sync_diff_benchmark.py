@@ -0,0 +1,76 @@
+#!/bin/env python
+# Copyright 2015 Zuercher Hochschule fuer Angewandte Wissenschaften
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''
+Benchmarks the user/tenant diff step of sync_users_to_tenants.py
+
+Builds synthetic users and tenants and times building the TenantIndex and diff_users_to_tenants, no keystone needed
+besides keystoneclient being importable.
+'''
+
+__author__ = 'ernm'
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sync_users_to_tenants import TenantIndex, diff_users_to_tenants
+
+
+class FakeUser(object):
+    def __init__(self, name, enabled):
+        self.name = name
+        self.enabled = enabled
+
+
+class FakeTenant(object):
+    def __init__(self, name):
+        self.name = name
+        self.enabled = True
+
+
+def build(size, tenant_fraction):
+    users = [FakeUser('user-%i' % i, u'true' if i % 10 else u'false') for i in range(size)]
+    tenants = [FakeTenant('user-%i' % i) for i in range(int(size * tenant_fraction))]
+    return users, tenants
+
+
+def main():
+    parser = argparse.ArgumentParser('sync_diff_benchmark.py')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='Comma separated numbers of users.')
+    parser.add_argument('--tenant-fraction', type=float, default=0.9, help='Fraction of users that have a tenant.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per size, the fastest one is reported.')
+    args = parser.parse_args()
+
+    print '%8s %8s %12s %12s' % ('users', 'tenants', 'index[ms]', 'diff[ms]')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        users, tenants = build(size, args.tenant_fraction)
+        index_times, diff_times = [], []
+        for _ in range(args.repeat):
+            started = time.time()
+            tenant_index = TenantIndex(tenants)
+            index_times.append(time.time() - started)
+            started = time.time()
+            diff_users_to_tenants(users, tenant_index)
+            diff_times.append(time.time() - started)
+        print '%8i %8i %12.2f %12.2f' % (size, len(tenants), min(index_times) * 1000, min(diff_times) * 1000)
+
+
+if __name__ == "__main__":
+    main()
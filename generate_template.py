@@ -0,0 +1,310 @@
+#!/bin/env python
+
+'''
+Generates heat templates for large SDC stacks from a compact fleet spec
+
+The template is written line by line while the spec is walked, so the document is never held in memory. Values
+shared by many resources (endpoint, owner, images, packages, existing networks, user-script) become parameters
+and every resource only references them.
+
+Example spec (yaml):
+
+    description: 1000 web servers in 5 networks
+    sapi_endpoint: 10.0.0.26
+    user_uuid: 72f70341-b227-4051-befd-b0d5e1588a6d
+    external_networks: [f3d68d27-e311-491a-9c7f-d2a8d386e6e6]
+    user_script: touch /test
+    networks:
+      count: 5
+      name: web_net
+      mask_bits: 24
+    machines:
+      - type: smartmachine
+        name: web
+        count: 1000
+        image: 62f148f8-6e84-11e4-82c5-efca60348b9f
+        package: b1abec1a-80e5-ea9e-e091-8f2d67feb252
+      - type: kvm_group
+        name: db
+        count: 2
+        group_size: 3
+        image: 02dbab66-a70a-11e4-819b-b3dc41b361d6
+        package: b1abec1a-80e5-ea9e-e091-8f2d67feb252
+        networks: [1, 2]
+
+machines use all networks of the stack unless networks lists the ones (counting from 1) they are attached to. Machine
+group names have to be unique and group_size (machines per resource) is required for the *_group types and not allowed
+for the others, a spec that breaks these or the other rules is rejected before anything is written.
+sapi_endpoint and user_uuid are left out of the resources if they are not in the spec, e.g. when sdc_plugin.conf
+overrides them. A user_script_template instead of user_script is rendered per machine with str_replace, the
+placeholders %instance_alias%, %image%, %package% and %networks% are available.
+'''
+
+__author__ = 'ernm'
+
+import argparse
+import json
+import sys
+
+import yaml
+
+MACHINE_TYPES = {'smartmachine': 'SDC::Compute::SmartMachine',
+                 'kvm': 'SDC::Compute::KVM',
+                 'smartmachine_group': 'SDC::Compute::SmartMachineGroup',
+                 'kvm_group': 'SDC::Compute::KVMGroup'}
+# machine types whose resources create group_size machines
+GROUP_TYPES = ('smartmachine_group', 'kvm_group')
+NETWORK_TYPE = 'SDC::Network::SmartNetwork'
+# kinds of values that can differ between machine groups, their parameters are numbered
+NUMBERED_KINDS = ('image', 'package')
+
+
+def quote(value):
+    '''
+    returns a yaml scalar for a string, json strings are valid yaml
+    :param value: string
+    :return: quoted string
+    '''
+    return json.dumps(value)
+
+
+class ParameterRegistry(object):
+    '''
+    collects distinct values and hands out one parameter name per value
+
+    values of NUMBERED_KINDS get the parameters image_1, image_2, ..., every other kind has one parameter named
+    after the kind
+    '''
+
+    def __init__(self):
+        self.parameters = []
+        self._names = {}
+        self._counts = {}
+
+    def add(self, kind, value, description, param_type='string'):
+        '''
+        returns the name of the parameter holding value, adds the parameter if the value is new
+        :param kind: name prefix, e.g. image
+        :param value: value of the parameter
+        :param description: description of the parameter
+        :param param_type: heat parameter type
+        :return: parameter name
+        '''
+        key = (kind, value)
+        if key not in self._names:
+            name = kind
+            if kind in NUMBERED_KINDS:
+                self._counts[kind] = self._counts.get(kind, 0) + 1
+                name = '%s_%i' % (kind, self._counts[kind])
+            self._names[key] = name
+            self.parameters.append((name, param_type, value, description))
+        return self._names[key]
+
+
+def validate_spec(spec):
+    '''
+    checks the parts of a spec that would otherwise produce a broken template
+    :param spec: fleet spec
+    :raise ValueError: describing the first problem found
+    '''
+    network_count = (spec.get('networks') or {}).get('count') or 0
+    names = set()
+    for number, group in enumerate(spec.get('machines') or [], 1):
+        group_type = group.get('type', 'smartmachine')
+        if group_type not in MACHINE_TYPES:
+            raise ValueError('machine group %i: unknown type %s, expected one of %s' %
+                             (number, group_type, ', '.join(sorted(MACHINE_TYPES))))
+        name = group.get('name', group_type)
+        # the resources of a group are called <name>_<index>, net_<index> is taken by the networks
+        if name in names or (name == 'net' and network_count):
+            raise ValueError('machine group %i: name %s is already used' % (number, name))
+        names.add(name)
+        group_size = group.get('group_size')
+        if group_type in GROUP_TYPES:
+            if isinstance(group_size, bool) or not isinstance(group_size, int) or group_size < 1:
+                raise ValueError('machine group %s: %s needs a positive integer group_size' % (name, group_type))
+        elif 'group_size' in group:
+            raise ValueError('machine group %s: group_size is only allowed for %s' % (name, ', '.join(GROUP_TYPES)))
+        for key in ('image', 'package'):
+            if not group.get(key):
+                raise ValueError('machine group %s: %s is missing' % (name, key))
+        for index in group.get('networks') or []:
+            if not isinstance(index, int) or not 1 <= index <= network_count:
+                raise ValueError('machine group %s: network %s does not exist, the spec has %i networks' %
+                                 (name, index, network_count))
+
+
+def collect_parameters(spec):
+    '''
+    registers the shared values of a spec as parameters
+    :param spec: fleet spec
+    :return: ParameterRegistry
+    '''
+    registry = ParameterRegistry()
+    if spec.get('sapi_endpoint'):
+        registry.add('sapi_endpoint', spec['sapi_endpoint'], 'The admin-IP address of the sapi instance')
+    if spec.get('user_uuid'):
+        registry.add('user_uuid', spec['user_uuid'], 'UUID of the owner of the machines and networks')
+    if spec.get('external_networks'):
+        registry.add('external_networks', ','.join(spec['external_networks']),
+                     'UUIDs of existing networks every machine is attached to, comma separated')
+    if spec.get('user_script_template'):
+        registry.add('user_script_template', spec['user_script_template'],
+                     'User-script rendered for every machine')
+    elif spec.get('user_script') is not None:
+        registry.add('user_script', spec['user_script'], 'Shell script to run at boot')
+    networks = spec.get('networks') or {}
+    if networks.get('count'):
+        registry.add('net_name', networks.get('name', 'net'), 'Name of the networks')
+        registry.add('net_mask_bits', networks.get('mask_bits', 24), 'Number of bits in the netmask',
+                     param_type='number')
+        registry.add('net_description', networks.get('description', ''), 'Description of the networks')
+    for group in spec.get('machines') or []:
+        registry.add('image', group['image'], 'Image uuid')
+        registry.add('package', group['package'], 'Package uuid')
+    return registry
+
+
+def generate_parameters(registry):
+    '''
+    yields the lines of the parameters section
+    :param registry: ParameterRegistry
+    '''
+    yield 'parameters:'
+    for name, param_type, value, description in registry.parameters:
+        yield '  %s:' % name
+        yield '    type: %s' % param_type
+        # quoted even if multi-line, block scalars would change leading whitespace and trailing newlines
+        yield '    default: %s' % (quote(value) if isinstance(value, basestring) else value)
+        yield '    description: %s' % quote(description)
+        yield ''
+
+
+def generate_networks(spec, registry):
+    '''
+    yields the lines of the network resources
+    :param spec: fleet spec
+    :param registry: ParameterRegistry
+    '''
+    networks = spec.get('networks') or {}
+    for index in range(1, (networks.get('count') or 0) + 1):
+        yield '  net_%i:' % index
+        yield '    type: %s' % NETWORK_TYPE
+        yield '    properties:'
+        if spec.get('sapi_endpoint'):
+            yield '      sapi_endpoint: { get_param: sapi_endpoint }'
+        if spec.get('user_uuid'):
+            yield '      owner_uuids: { get_param: user_uuid }'
+        yield '      name: { get_param: net_name }'
+        yield '      mask_bits: { get_param: net_mask_bits }'
+        yield '      description: { get_param: net_description }'
+
+
+def networks_expression(spec, group):
+    '''
+    returns the flow list joined into the networks property of a machine
+    :param spec: fleet spec
+    :param group: machine group of the spec
+    '''
+    network_count = (spec.get('networks') or {}).get('count') or 0
+    indexes = group.get('networks') or range(1, network_count + 1)
+    items = []
+    if spec.get('external_networks'):
+        items.append('get_param: external_networks')
+    items.extend('get_attr: [ net_%i, uuid ]' % index for index in indexes)
+    return '[ %s ]' % ', '.join(items)
+
+
+def generate_machines(spec, registry):
+    '''
+    yields the lines of the machine resources
+    :param spec: fleet spec
+    :param registry: ParameterRegistry
+    '''
+    for group in spec.get('machines') or []:
+        group_type = group.get('type', 'smartmachine')
+        resource_type = MACHINE_TYPES[group_type]
+        name = group.get('name', group_type)
+        image = registry.add('image', group['image'], 'Image uuid')
+        package = registry.add('package', group['package'], 'Package uuid')
+        networks = networks_expression(spec, group)
+        for index in range(1, group.get('count', 1) + 1):
+            alias = '%s_%i' % (name, index)
+            yield '  %s:' % alias
+            yield '    type: %s' % resource_type
+            yield '    properties:'
+            if spec.get('sapi_endpoint'):
+                yield '      sapi_endpoint: { get_param: sapi_endpoint }'
+            if spec.get('user_uuid'):
+                yield '      user_uuid: { get_param: user_uuid }'
+            yield '      instance_alias: %s' % quote(alias)
+            yield '      package: { get_param: %s }' % package
+            yield '      image: { get_param: %s }' % image
+            if group_type in GROUP_TYPES:
+                yield '      count: %i' % group['group_size']
+            yield '      networks: { "Fn::Join": [ ",", %s ] }' % networks
+            if spec.get('user_script_template'):
+                yield '      user_script:'
+                yield '        str_replace:'
+                yield '          template: { get_param: user_script_template }'
+                yield '          params:'
+                yield '            "%%instance_alias%%": %s' % quote(alias)
+                yield '            "%%image%%": { get_param: %s }' % image
+                yield '            "%%package%%": { get_param: %s }' % package
+                yield '            "%%networks%%": { "Fn::Join": [ ",", %s ] }' % networks
+            elif spec.get('user_script') is not None:
+                yield '      user_script: { get_param: user_script }'
+
+
+def generate_template(spec):
+    '''
+    yields the lines of the heat template for a fleet spec, the spec is validated before the first line
+    :param spec: fleet spec
+    '''
+    validate_spec(spec)
+    registry = collect_parameters(spec)
+    yield 'heat_template_version: 2013-05-23'
+    yield ''
+    yield 'description: %s' % quote(spec.get('description', 'Generated SDC stack'))
+    yield ''
+    for line in generate_parameters(registry):
+        yield line
+    yield 'resources:'
+    for line in generate_networks(spec, registry):
+        yield line
+    for line in generate_machines(spec, registry):
+        yield line
+
+
+def write_template(spec, out):
+    '''
+    writes the heat template for a fleet spec line by line
+    :param spec: fleet spec
+    :param out: file object
+    :return: number of lines written
+    '''
+    lines = 0
+    for line in generate_template(spec):
+        out.write(line)
+        out.write('\n')
+        lines += 1
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('generate_template.py')
+    parser.add_argument('spec', help='Fleet spec (yaml).')
+    parser.add_argument('-o', '--output', help='Template file to write, defaults to stdout.')
+    args = parser.parse_args()
+
+    with open(args.spec) as spec_file:
+        fleet_spec = yaml.safe_load(spec_file)
+    try:
+        validate_spec(fleet_spec)
+    except ValueError as e:
+        sys.exit('Invalid fleet spec %s: %s' % (args.spec, e))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            write_template(fleet_spec, output_file)
+    else:
+        write_template(fleet_spec, sys.stdout)
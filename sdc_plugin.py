@@ -18,9 +18,26 @@ __author__ = 'ernm'
 
 from sdcadmin.datacenter import DataCenter
 
+import hashlib
+import json
+import os
+import random
+import re
+import signal
+import socket
+import threading
+import time
 import uuid
-from ConfigParser import SafeConfigParser
+from collections import Counter, OrderedDict, deque
+from ConfigParser import Error as ConfigError, SafeConfigParser
 
+import eventlet
+import requests
+from netaddr import IPNetwork
+from requests.adapters import HTTPAdapter
+
+from heat.common import exception
+from heat.engine import constraints
 from heat.engine import properties
 from heat.engine import resource
 from heat.common.i18n import _
@@ -28,37 +45,1655 @@ from oslo_log import log as logging
 
 logger = logging.getLogger(__name__)
 
-#TODO: improve cfg-loading
 SDC_CONFIG_FILE = '/opt/heat/plugins/sdc_plugin.conf'
 #SDC_CONFIG_FILE = '/usr/lib/heat/sdc_plugin.conf'
 
-cfg_parser = SafeConfigParser()
-cfg_parser.read(SDC_CONFIG_FILE)
+# seconds between two mtime checks of SDC_CONFIG_FILE
+CONFIG_CHECK_INTERVAL = 5
+
+
+class SDCConfig(object):
+    '''
+    Typed view of sdc_plugin.conf
+
+    The file is parsed once and read again when its mtime changes (checked at most every check_interval
+    seconds) or after the engine received SIGHUP. A missing file or option falls back to the defaults below, a file
+    that cannot be parsed on reload is logged and the previous config stays in use.
+    override_endpoints, override_owner and override_nic_tag also shape the properties_schema of the resources,
+    changing them still requires a heat-engine restart.
+    '''
+
+    # section, option, default
+    BOOLEAN_OPTIONS = (
+        ('RESOURCES', 'enable_smartmachine', True),
+        ('RESOURCES', 'enable_kvm', True),
+        ('RESOURCES', 'enable_network', False),
+        ('RESOURCES', 'enable_smart_network', True),
+        ('RESOURCES', 'enable_smartmachine_group', False),
+        ('RESOURCES', 'enable_kvm_group', False),
+        ('OVERRIDE', 'override_owner', False),
+        ('OVERRIDE', 'override_endpoints', False),
+        ('OVERRIDE', 'override_nic_tag', False),
+        ('OVERRIDE', 'real_owner', False),
+        ('PREFETCH', 'prefetch_images', False),
+    )
+    STRING_OPTIONS = (
+        ('OVERRIDE', 'override_owner_uuid', None),
+        ('OVERRIDE', 'override_sapi_endpoint', None),
+        ('OVERRIDE', 'override_vmapi_endpoint', None),
+        ('OVERRIDE', 'override_nic_tag_name', 'customer'),
+        ('METRICS', 'prometheus_file', None),
+        ('METRICS', 'statsd_target', None),
+        ('PREFETCH', 'prefetch_source', 'https://images.joyent.com'),
+    )
+    NUMBER_OPTIONS = (
+        ('METRICS', 'export_interval', 15),
+        ('PREFETCH', 'prefetch_timeout', 600),
+    )
+    INTEGER_OPTIONS = (
+        ('ROLLING_UPDATE', 'batch_size', 50),
+        ('ROLLING_UPDATE', 'max_in_flight', 10),
+        ('PREFETCH', 'prefetch_concurrency', 4),
+    )
+    # batch and pool sizes, smaller values would leave the queued work pending forever
+    POSITIVE_OPTIONS = ('batch_size', 'max_in_flight', 'prefetch_concurrency')
+
+    def __init__(self, path, check_interval=CONFIG_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._mtime = None
+        self._checked_at = 0
+        self._reload_requested = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        '''
+        reads the config file, raises ConfigError or ValueError if it is malformed
+        '''
+        mtime = self._get_mtime()
+        options = self._parse()
+        # all options are replaced at once, readers never see a half applied config
+        self.__dict__.update(options)
+        self._mtime = mtime
+        self._checked_at = time.time()
+        logger.debug("SDC plugin config loaded from %s" % self.path)
+
+    def _parse(self):
+        cfg_parser = SafeConfigParser()
+        if not cfg_parser.read(self.path):
+            logger.warning("SDC plugin config %s not found, using defaults" % self.path)
+        options = {}
+        for section, option, default in self.BOOLEAN_OPTIONS:
+            value = default
+            if cfg_parser.has_option(section, option):
+                value = cfg_parser.getboolean(section, option)
+            options[option] = value
+        for section, option, default in self.STRING_OPTIONS:
+            value = default
+            if cfg_parser.has_option(section, option):
+                value = cfg_parser.get(section, option) or default
+            options[option] = value
+        for section, option, default in self.NUMBER_OPTIONS:
+            value = default
+            if cfg_parser.has_option(section, option):
+                value = cfg_parser.getfloat(section, option)
+            options[option] = value
+        for section, option, default in self.INTEGER_OPTIONS:
+            value = default
+            if cfg_parser.has_option(section, option):
+                value = cfg_parser.getint(section, option)
+            options[option] = value
+        for option in self.POSITIVE_OPTIONS:
+            if options[option] < 1:
+                logger.warning("SDC plugin config: %s = %s is too small, using 1" % (option, options[option]))
+                options[option] = 1
+        options['rate_limits'] = {}
+        if cfg_parser.has_section('RATE_LIMIT'):
+            for name, value in cfg_parser.items('RATE_LIMIT'):
+                limit = self._parse_rate_limit(value)
+                if limit is None:
+                    logger.warning("Ignoring invalid rate limit %s = %s" % (name, value))
+                elif any(limit):
+                    options['rate_limits'][name] = limit
+        return options
+
+    @staticmethod
+    def _parse_rate_limit(value):
+        # rate/burst/max_concurrent, empty or 0 parts are unlimited
+        parts = [part.strip() for part in value.split('/')]
+        if len(parts) > 3:
+            return None
+        parts += [''] * (3 - len(parts))
+        try:
+            return float(parts[0] or 0), int(parts[1] or 0), int(parts[2] or 0)
+        except ValueError:
+            return None
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def request_reload(self):
+        # called from the signal handler, the actual reload happens on the next access
+        self._reload_requested = True
+
+    def reload_if_changed(self):
+        now = time.time()
+        if not self._reload_requested and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            if self._reload_requested or self._get_mtime() != self._mtime:
+                self._reload_requested = False
+                try:
+                    self.load()
+                except (ConfigError, ValueError) as e:
+                    # reported once per edit, the next change of the file is tried again
+                    self._mtime = self._get_mtime()
+                    logger.error("Keeping the previous SDC plugin config, %s is invalid: %s" % (self.path, e))
+
+
+sdc_config = SDCConfig(SDC_CONFIG_FILE)
 
-if cfg_parser.get('OVERRIDE', 'override_nic_tag') == 'True':
-    override_nic_tag = True
-    override_nic_tag_name = cfg_parser.get('OVERRIDE', 'override_nic_tag_name')
-else:
-    override_nic_tag = False
 
-if cfg_parser.get('OVERRIDE', 'override_owner') == 'True':
-    override_owner = True
-    override_owner_uuid = cfg_parser.get('OVERRIDE', 'override_owner_uuid')
-else:
-    override_owner = False
+def get_config():
+    sdc_config.reload_if_changed()
+    return sdc_config
 
-if cfg_parser.get('OVERRIDE', 'real_owner') == 'True':
-    real_owner = True
-else:
-    real_owner = False
 
+def _install_sighup_handler():
+    previous_handler = signal.getsignal(signal.SIGHUP)
 
-if cfg_parser.get('OVERRIDE', 'override_endpoints') == 'True':
-    override_endpoints = True
-    override_sapi_endpoint = cfg_parser.get('OVERRIDE', 'override_sapi_endpoint')
-    override_vmapi_endpoint = cfg_parser.get('OVERRIDE', 'override_vmapi_endpoint')
-else:
-    override_endpoints = False
+    def handler(signum, frame):
+        sdc_config.request_reload()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+
+    try:
+        signal.signal(signal.SIGHUP, handler)
+    except ValueError:
+        # plugin not loaded from the main thread, the mtime check still picks up changes
+        pass
+
+
+_install_sighup_handler()
+
+# upper bounds in seconds of the SDC API latency histograms
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# admission control: stack share of requests made outside of a resource, e.g. by the batching coordinators
+ADMISSION_DEFAULT_STACK = '-'
+
+# DataCenter client pool settings
+DC_POOL_MAX_CLIENTS = 16
+DC_POOL_IDLE_TIMEOUT = 600
+DC_POOL_CONNECTIONS = 10
+DC_POOL_MAXSIZE = 50
+
+# network provisioning settings
+NETWORK_BATCH_WINDOW = 0.2
+NETWORK_CREATE_CONCURRENCY = 10
+
+# seconds user-script updates are collected before a rolling update starts and between two bulk confirmations
+ROLLING_UPDATE_WINDOW = 0.2
+ROLLING_UPDATE_CONFIRM_INTERVAL = 2
+
+# validation catalog settings
+CATALOG_TTL = 300
+CATALOG_MISS_REFRESH_INTERVAL = 10
+UUID_PATTERN = re.compile('^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+# seconds between two state checks of an image that is being imported
+IMAGE_IMPORT_POLL_INTERVAL = 2
+
+# teardown settings
+TEARDOWN_WINDOW = 0.2
+TEARDOWN_CONCURRENCY = 20
+NETWORK_RELEASE_CHECK_INTERVAL = 2
+NETWORK_RELEASE_TIMEOUT = 600
+
+# VM status poller settings
+VM_STATUS_POLL_INTERVAL = 2
+VM_STATUS_BATCH_SIZE = 100
+VM_STATUS_WATCH_TIMEOUT = 300
+
+# attribute cache settings
+ATTRIBUTE_CACHE_TTL = 30
+ATTRIBUTE_CACHE_SIZE = 1024
+# nic tag the external_ip attribute reports
+EXTERNAL_NIC_TAG = 'external'
+
+# readiness scheduler settings
+READINESS_INITIAL_DELAY = 1
+READINESS_MAX_DELAY = 15
+READINESS_EARLY_FRACTION = 0.8
+READINESS_SMOOTHING = 0.3
+READINESS_STALE_FACTOR = 20
+
+# number of concurrent VMAPI jobs submitted for a single resource, i.e. a machine group
+MACHINE_ACTION_CONCURRENCY = 10
+
+# seconds the nova keypairs of a user are reused for ssh_keys injection
+KEYPAIR_CACHE_TTL = 60
+
+
+class APIMetrics(object):
+    '''
+    Latency histograms, error counts and in-flight gauges of all SDC API calls per operation and endpoint
+
+    An operation is the HTTP method, the API and the path with UUIDs replaced, e.g. "GET vmapi /vms/:uuid".
+    Depending on the [METRICS] section of the config the metrics are written to a file in Prometheus text
+    format every export_interval seconds and/or sent as statsd timers and counters to a UDP host:port or
+    appended to a file.
+    '''
+
+    UUID_RE = re.compile('[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+    ACTION_RE = re.compile('action=([a-z_]+)')
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._errors = Counter()
+        self._in_flight = Counter()
+        self._exported_at = 0
+        self._statsd_socket = None
+        self._lock = threading.Lock()
+
+    def operation_name(self, method, api, path):
+        path, _, query = path.partition('?')
+        operation = '%s %s %s' % (method, api, self.UUID_RE.sub(':uuid', path))
+        action = self.ACTION_RE.search(query)
+        if action:
+            operation += '?action=' + action.group(1)
+        return operation
+
+    def start(self, operation, endpoint):
+        with self._lock:
+            self._in_flight[(operation, endpoint)] += 1
+
+    def finish(self, operation, endpoint, duration, error):
+        key = (operation, endpoint)
+        with self._lock:
+            self._in_flight[key] -= 1
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += duration
+            histogram['count'] += 1
+            if error:
+                self._errors[key] += 1
+        cfg = get_config()
+        if cfg.statsd_target:
+            self._send_statsd(cfg.statsd_target, operation, duration, error)
+        if cfg.prometheus_file and time.time() - self._exported_at >= cfg.export_interval:
+            self._exported_at = time.time()
+            self.export_prometheus(cfg.prometheus_file)
+
+    @staticmethod
+    def _labels(operation, endpoint, **extra):
+        labels = [('operation', operation), ('endpoint', endpoint)] + sorted(extra.items())
+        return ','.join('%s="%s"' % (name, value) for name, value in labels)
+
+    def prometheus_text(self):
+        with self._lock:
+            histograms = dict((key, dict(value, buckets=list(value['buckets'])))
+                              for key, value in self._histograms.items())
+            errors = dict(self._errors)
+            in_flight = dict(self._in_flight)
+        lines = ['# HELP sdc_api_request_duration_seconds Latency of SDC API requests.',
+                 '# TYPE sdc_api_request_duration_seconds histogram']
+        for (operation, endpoint), histogram in sorted(histograms.items()):
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append('sdc_api_request_duration_seconds_bucket{%s} %i' %
+                             (self._labels(operation, endpoint, le=bound), count))
+            lines.append('sdc_api_request_duration_seconds_bucket{%s} %i' %
+                         (self._labels(operation, endpoint, le='+Inf'), histogram['count']))
+            lines.append('sdc_api_request_duration_seconds_sum{%s} %f' %
+                         (self._labels(operation, endpoint), histogram['sum']))
+            lines.append('sdc_api_request_duration_seconds_count{%s} %i' %
+                         (self._labels(operation, endpoint), histogram['count']))
+        lines += ['# HELP sdc_api_request_errors_total Failed SDC API requests.',
+                  '# TYPE sdc_api_request_errors_total counter']
+        for (operation, endpoint), count in sorted(errors.items()):
+            lines.append('sdc_api_request_errors_total{%s} %i' % (self._labels(operation, endpoint), count))
+        lines += ['# HELP sdc_api_requests_in_flight SDC API requests waiting for a response.',
+                  '# TYPE sdc_api_requests_in_flight gauge']
+        for (operation, endpoint), count in sorted(in_flight.items()):
+            lines.append('sdc_api_requests_in_flight{%s} %i' % (self._labels(operation, endpoint), count))
+        lines += ['# HELP sdc_datacenter_pool Lookups and size of the shared DataCenter client pool.',
+                  '# TYPE sdc_datacenter_pool gauge']
+        for name, value in sorted(dc_pool.stats().items()):
+            lines.append('sdc_datacenter_pool{stat="%s"} %i' % (name, value))
+        lines += ['# HELP sdc_api_admission Requests in flight, waiting, admitted and delayed per [RATE_LIMIT] limit.',
+                  '# TYPE sdc_api_admission gauge']
+        for (name, endpoint), stats in sorted(admission_controller.stats().items()):
+            for stat, value in sorted(stats.items()):
+                lines.append('sdc_api_admission{limit="%s",endpoint="%s",stat="%s"} %i' %
+                             (name, endpoint, stat, value))
+        return '\n'.join(lines) + '\n'
+
+    def export_prometheus(self, path):
+        # write and rename, so that collectors never read a partial file
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.prometheus_text())
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not export SDC API metrics to %s: %s" % (path, e))
+
+    def _send_statsd(self, target, operation, duration, error):
+        name = 'sdc_plugin.' + re.sub('[^a-zA-Z0-9_]+', '_', operation).strip('_')
+        lines = ['%s.duration:%i|ms' % (name, duration * 1000)]
+        if error:
+            lines.append('%s.errors:1|c' % name)
+        try:
+            if target.startswith('/'):
+                with open(target, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+            else:
+                host, port = target.rsplit(':', 1)
+                if self._statsd_socket is None:
+                    self._statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._statsd_socket.sendto('\n'.join(lines), (host, int(port)))
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("Could not send SDC API metrics to %s: %s" % (target, e))
+
+
+api_metrics = APIMetrics()
+
+
+class RateLimit(object):
+    '''
+    Token bucket and concurrency limit of one endpoint or operation class
+
+    A request takes a token (rate per second, at most burst saved up) and a slot (max_concurrent in flight), a
+    rate or max_concurrent of 0 does not limit. Requests that cannot be admitted wait in one queue per stack and
+    the queues are served round robin, so a large stack cannot starve the others.
+    '''
+
+    def __init__(self, name, rate, burst, max_concurrent):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst or int(rate), 1)
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.admitted = 0
+        self.delayed = 0
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._queues = OrderedDict()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def configure(self, rate, burst, max_concurrent):
+        with self._lock:
+            self._refill(time.time())
+            self.rate = rate
+            self.burst = max(burst or int(rate), 1)
+            self.max_concurrent = max_concurrent
+            self._tokens = min(self._tokens, self.burst)
+            self._dispatch()
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._queues.values())
+
+    def acquire(self, stack):
+        with self._lock:
+            self._refill(time.time())
+            if not self._queues and self._can_admit():
+                self._take()
+                return
+            event = threading.Event()
+            self._queues.setdefault(stack, deque()).append(event)
+            self.delayed += 1
+            self._schedule()
+        try:
+            event.wait()
+        except BaseException:
+            # killed while queued: leave the queue, or hand back the slot if it was granted meanwhile
+            with self._lock:
+                waiters = self._queues.get(stack)
+                if waiters is not None and event in waiters:
+                    waiters.remove(event)
+                    if not waiters:
+                        del self._queues[stack]
+                else:
+                    self._release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _can_admit(self):
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            return False
+        return not self.rate or self._tokens >= 1
+
+    def _take(self):
+        self.in_flight += 1
+        self.admitted += 1
+        if self.rate:
+            self._tokens -= 1
+
+    def _dispatch(self):
+        self._refill(time.time())
+        while self._queues and self._can_admit():
+            stack, waiters = self._queues.popitem(last=False)
+            event = waiters.popleft()
+            if waiters:
+                # the stack goes to the back of the line
+                self._queues[stack] = waiters
+            self._take()
+            event.set()
+        if self._queues:
+            self._schedule()
+
+    def _schedule(self):
+        # a full bucket of slots is refilled by release(), missing tokens need a timer
+        if self._timer is None and self.rate and self._tokens < 1:
+            self._timer = eventlet.spawn_after((1 - self._tokens) / self.rate, self._on_timer)
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+
+class AdmissionController(object):
+    '''
+    Admission control for all SDC API requests, configured by the [RATE_LIMIT] section of the config
+
+    Limits are named after the API ("vmapi") or the API and an operation class ("vmapi.create") and apply to every
+    endpoint of that API separately. A request passes the limit of its operation class first and then the one of
+    its API. The stack a request belongs to is taken from the greenthread, set_stack() is called when a resource
+    gets its DataCenter and bind() carries it over to the greenthreads of a resource.
+    '''
+
+    def __init__(self):
+        self._limits = {}
+        self._specs = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def set_stack(self, stack_id):
+        self._local.stack = stack_id
+
+    def current_stack(self):
+        return getattr(self._local, 'stack', None) or ADMISSION_DEFAULT_STACK
+
+    def bind(self, func):
+        '''
+        returns func wrapped to run on behalf of the current stack, e.g. in the greenthreads of a GreenPool
+        '''
+        stack = self.current_stack()
+
+        def bound(*args, **kwargs):
+            self.set_stack(stack)
+            return func(*args, **kwargs)
+        return bound
+
+    @staticmethod
+    def operation_class(method, path):
+        path, _, query = path.partition('?')
+        if method == 'GET':
+            return 'read'
+        if path.endswith('/customer_metadata') or 'action=update' in query:
+            return 'metadata'
+        if method == 'DELETE':
+            return 'delete'
+        if 'action=' in query:
+            return 'action'
+        if method == 'POST':
+            return 'create'
+        return 'update'
+
+    def acquire(self, method, api, endpoint, path):
+        '''
+        waits until the request may be sent
+        :return: the acquired limits, to be passed to release()
+        '''
+        specs = get_config().rate_limits
+        if specs is not self._specs:
+            self._configure(specs)
+        if not specs:
+            return []
+        acquired = []
+        stack = self.current_stack()
+        try:
+            for name in ('%s.%s' % (api, self.operation_class(method, path)), api):
+                limit = self._get_limit(name, endpoint)
+                if limit is not None:
+                    limit.acquire(stack)
+                    acquired.append(limit)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return acquired
+
+    @staticmethod
+    def release(limits):
+        for limit in limits:
+            limit.release()
+
+    def _get_limit(self, name, endpoint):
+        spec = self._specs.get(name)
+        if spec is None:
+            return None
+        with self._lock:
+            limit = self._limits.get((name, endpoint))
+            if limit is None:
+                limit = self._limits[(name, endpoint)] = RateLimit(name, *spec)
+            return limit
+
+    def _configure(self, specs):
+        with self._lock:
+            self._specs = specs
+            for key, limit in self._limits.items():
+                spec = specs.get(key[0])
+                if spec is None:
+                    # lets the queued requests through, new requests skip the limit
+                    del self._limits[key]
+                    limit.configure(0, 0, 0)
+                else:
+                    limit.configure(*spec)
+
+    def stats(self):
+        with self._lock:
+            limits = self._limits.items()
+        return dict((key, {'in_flight': limit.in_flight,
+                           'waiting': limit.waiting(),
+                           'admitted': limit.admitted,
+                           'delayed': limit.delayed}) for key, limit in limits)
+
+
+admission_controller = AdmissionController()
+
+
+class PooledDataCenter(DataCenter):
+    '''
+    DataCenter that sends all API requests through one keep-alive session
+
+    The pollers, coordinators and caches of a DataCenter are kept in components. A client created for the same
+    endpoints again, e.g. after the pool evicted the previous one, takes them over with their state.
+    '''
+
+    def __init__(self, sapi, vmapi=None, pool_connections=DC_POOL_CONNECTIONS, pool_maxsize=DC_POOL_MAXSIZE,
+                 components=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # DataCenter.__init__ already resolves the remaining endpoints through SAPI, i.e. uses the session
+        super(PooledDataCenter, self).__init__(sapi=sapi, vmapi=vmapi)
+        self.components = components if components is not None else {}
+        for name, component_class in (('status_poller', VMStatusPoller),
+                                      ('network_provisioner', NetworkProvisioner),
+                                      ('metadata_updater', MetadataUpdateCoordinator),
+                                      ('teardown', TeardownCoordinator),
+                                      ('catalog', CatalogCache),
+                                      ('image_prefetcher', ImagePrefetcher)):
+            component = self.components.get(name)
+            if component is None:
+                component = self.components[name] = component_class(self)
+            else:
+                component.dc = self
+            setattr(self, name, component)
+
+    def request(self, method, api, path, headers=None, data=None, **kwargs):
+        full_path = getattr(self, api) + path
+        request_headers = {}
+        request_headers.update(self.default_headers)
+        if headers:
+            request_headers.update(headers)
+        jdata = None
+        if data:
+            jdata = json.dumps(data)
+
+        operation = api_metrics.operation_name(method, api, path)
+        endpoint = getattr(self, api)
+        limits = admission_controller.acquire(method, api, endpoint, path)
+        api_metrics.start(operation, endpoint)
+        started = time.time()
+        error = True
+        try:
+            resp = self.session.request(method, full_path, headers=request_headers, data=jdata, **kwargs)
+            error = resp.status_code >= 400
+        finally:
+            api_metrics.finish(operation, endpoint, time.time() - started, error)
+            admission_controller.release(limits)
+        if resp.content:
+            if resp.headers.get('content-type', '').startswith('application/json'):
+                return (json.loads(resp.content), resp)
+            else:
+                return (resp.content, resp)
+        else:
+            return (None, resp)
+
+    def get_machine_snapshot(self, vm_uuid):
+        '''
+        returns a MachineSnapshot of a VM from one request, None if VMAPI does not know the VM
+        '''
+        data, response = self.request('GET', 'vmapi', '/vms/%s' % vm_uuid)
+        if response.status_code == 404 or not isinstance(data, dict) or not data.get('uuid'):
+            return None
+        return MachineSnapshot.from_vm(data)
+
+    def get_machine_snapshots(self, vm_uuids):
+        '''
+        returns MachineSnapshots of many VMs keyed by uuid, VM_STATUS_BATCH_SIZE VMs per request
+        '''
+        snapshots = {}
+        for i in range(0, len(vm_uuids), VM_STATUS_BATCH_SIZE):
+            batch = vm_uuids[i:i + VM_STATUS_BATCH_SIZE]
+            vms, response = self.request('GET', 'vmapi', '/vms', params={'uuids': ','.join(batch)})
+            response.raise_for_status()
+            for vm in vms or []:
+                snapshots[vm.get('uuid')] = MachineSnapshot.from_vm(vm)
+        return snapshots
+
+    def get_user_script_digests(self, vm_uuids):
+        '''
+        returns the user_script_digest of many VMs keyed by uuid, only uuid and customer_metadata are requested
+        '''
+        digests = {}
+        for i in range(0, len(vm_uuids), VM_STATUS_BATCH_SIZE):
+            batch = vm_uuids[i:i + VM_STATUS_BATCH_SIZE]
+            vms, response = self.request('GET', 'vmapi', '/vms',
+                                         params={'uuids': ','.join(batch), 'fields': 'uuid,customer_metadata'})
+            response.raise_for_status()
+            for vm in vms or []:
+                digests[vm.get('uuid')] = user_script_digest((vm.get('customer_metadata') or {}).get('user-script'))
+        return digests
+
+    def machine_action(self, vm_uuid, action):
+        '''
+        stops, starts or deletes a VM without fetching it first
+        '''
+        if action == 'delete':
+            raw_job_data, response = self.request('DELETE', 'vmapi', '/vms/%s' % vm_uuid)
+        else:
+            raw_job_data, response = self.request('POST', 'vmapi', '/vms/%s?action=%s' % (vm_uuid, action))
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+class VMStatusPoller(object):
+    '''
+    Shared VM state cache filled by bulk VMAPI /statuses calls
+
+    Resources watch the VM UUIDs they are waiting on. The first reader that finds the cache older than interval
+    fetches the state of all watched VMs at once (batch_size UUIDs per request), every other reader within the
+    same interval is served from the cache. VMs nobody read for watch_timeout seconds, e.g. of operations heat
+    abandoned, are no longer fetched.
+    '''
+
+    STATE_UNKNOWN = 'unknown'
+
+    def __init__(self, dc, interval=VM_STATUS_POLL_INTERVAL, batch_size=VM_STATUS_BATCH_SIZE,
+                 watch_timeout=VM_STATUS_WATCH_TIMEOUT):
+        self.dc = dc
+        self.interval = interval
+        self.batch_size = batch_size
+        self.watch_timeout = watch_timeout
+        self._watched = set()
+        self._states = {}
+        self._state_fetched_at = {}
+        self._read_at = {}
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def watch(self, vm_uuid):
+        # drops a previously cached state, it belongs to an operation that is already over
+        with self._lock:
+            self._watched.add(vm_uuid)
+            self._read_at[vm_uuid] = time.time()
+            self._states.pop(vm_uuid, None)
+            self._state_fetched_at.pop(vm_uuid, None)
+
+    def unwatch(self, vm_uuid):
+        with self._lock:
+            self._forget(vm_uuid)
+
+    def _forget(self, vm_uuid):
+        self._watched.discard(vm_uuid)
+        self._read_at.pop(vm_uuid, None)
+        self._states.pop(vm_uuid, None)
+        self._state_fetched_at.pop(vm_uuid, None)
+
+    def fetched_at(self, vm_uuid):
+        '''
+        returns when the cached state of a VM was last returned by VMAPI, None if it never was
+        '''
+        with self._lock:
+            return self._state_fetched_at.get(vm_uuid)
+
+    def get_state(self, vm_uuid):
+        '''
+        returns the cached state of a VM, None if it has not been fetched yet
+        and STATE_UNKNOWN if VMAPI does not know the VM
+        '''
+        now = time.time()
+        with self._lock:
+            self._watched.add(vm_uuid)
+            self._read_at[vm_uuid] = now
+            stale = now - self._fetched_at >= self.interval
+        if stale:
+            self.refresh()
+        with self._lock:
+            return self._states.get(vm_uuid)
+
+    def refresh(self):
+        with self._refresh_lock:
+            # another greenthread may have refreshed while we were waiting for the lock
+            if time.time() - self._fetched_at < self.interval:
+                return
+            with self._lock:
+                deadline = time.time() - self.watch_timeout
+                for vm_uuid in [vm_uuid for vm_uuid in self._watched if self._read_at.get(vm_uuid, 0) < deadline]:
+                    self._forget(vm_uuid)
+                vm_uuids = list(self._watched)
+            states = {}
+            for i in range(0, len(vm_uuids), self.batch_size):
+                batch = vm_uuids[i:i + self.batch_size]
+                # a failed query says nothing about the VMs, their cached states are kept
+                try:
+                    status_data, response = self.dc.request('GET', 'vmapi', '/statuses',
+                                                            params={'uuids': ','.join(batch)})
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    logger.warning(_("Fetching the state of %i VMs failed: %s") % (len(batch), e))
+                    continue
+                status_data = status_data if isinstance(status_data, dict) else {}
+                for vm_uuid in batch:
+                    states[vm_uuid] = status_data.get(vm_uuid) or self.STATE_UNKNOWN
+            logger.debug("fetched state of %i VMs in %i requests" %
+                         (len(vm_uuids), (len(vm_uuids) + self.batch_size - 1) // self.batch_size))
+            now = time.time()
+            with self._lock:
+                self._states.update(states)
+                self._state_fetched_at.update((vm_uuid, now) for vm_uuid in states)
+                self._fetched_at = now
+
+
+class PendingNetwork(object):
+    '''
+    Network create queued in a NetworkProvisioner
+
+    on_created is called with the new network as soon as NAPI returned it, i.e. before check_create_complete.
+    '''
+
+    def __init__(self, params, mask_bits=None, on_created=None):
+        self.params = params
+        self.mask_bits = mask_bits
+        self.on_created = on_created
+        self.network = None
+        self.error = None
+        self._done = threading.Event()
+
+    def succeed(self, network):
+        self.network = network
+        if self.on_created:
+            try:
+                self.on_created(network)
+            except Exception as e:
+                logger.error(_("Recording network %s failed: %s") % (network.uuid, e))
+        self._done.set()
+
+    def fail(self, error):
+        self.error = error
+        self._done.set()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error:
+            raise self.error
+        return self.network
+
+
+class NetworkProvisioner(object):
+    '''
+    Collects the network creates that arrive within window seconds and submits them concurrently
+
+    Smart networks (submitted with mask_bits) get their VLAN and subnet allocated for the whole batch from a
+    single NAPI network listing, instead of two listings per network. The VLAN and subnet of every create that
+    is still in flight stay reserved until NAPI returned the network, so neither the same nor a later batch
+    picks them again.
+    '''
+
+    def __init__(self, dc, window=NETWORK_BATCH_WINDOW, concurrency=NETWORK_CREATE_CONCURRENCY):
+        self.dc = dc
+        self.window = window
+        self.concurrency = concurrency
+        self._queue = []
+        self._flush_scheduled = False
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._allocate_lock = threading.Lock()
+
+    def submit(self, params, mask_bits=None, on_created=None):
+        '''
+        queues a network create
+        :param params: keyword arguments for DataCenter.create_network
+        :param mask_bits: allocate a free subnet of this size and a free VLAN (smart network)
+        :param on_created: called with the network once NAPI created it
+        :return: PendingNetwork
+        '''
+        pending = PendingNetwork(params, mask_bits, on_created)
+        with self._lock:
+            self._queue.append(pending)
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                eventlet.spawn_after(self.window, self._flush)
+        return pending
+
+    def _flush(self):
+        with self._lock:
+            batch = self._queue
+            self._queue = []
+            self._flush_scheduled = False
+            # networks with a fixed subnet and VLAN are not listed by NAPI until they are created
+            for pending in batch:
+                if not pending.mask_bits and pending.params.get('subnet'):
+                    self._reserved[pending] = (pending.params.get('vlan_id'), pending.params['subnet'])
+
+        smart = [pending for pending in batch if pending.mask_bits]
+        if smart:
+            try:
+                self._allocate(smart)
+            except Exception as e:
+                logger.error(_("Allocating networks failed: %s") % e)
+                for pending in smart:
+                    self._release(pending)
+                    pending.fail(e)
+
+        logger.debug("creating %i networks concurrently" % len(batch))
+        pool = eventlet.GreenPool(self.concurrency)
+        for pending in batch:
+            if not pending.ready():
+                pool.spawn_n(self._create, pending)
+        pool.waitall()
+
+    def _create(self, pending):
+        try:
+            pending.succeed(self.dc.create_network(**pending.params))
+        except Exception as e:
+            logger.error(_("Creating network %s failed: %s") % (pending.params.get('name'), e))
+            pending.fail(e)
+        finally:
+            self._release(pending)
+
+    def _release(self, pending):
+        with self._lock:
+            self._reserved.pop(pending, None)
+
+    def _allocate(self, smart):
+        # one batch at a time, a listing must not miss the reservations of a concurrent batch
+        with self._allocate_lock:
+            networks = self.dc.list_networks()
+            used_vlans = set(network.vlan_id for network in networks)
+            used_subnets = [IPNetwork(network.subnet) for network in networks if network.subnet]
+            with self._lock:
+                reserved = self._reserved.values()
+            for vlan_id, subnet in reserved:
+                used_vlans.add(vlan_id)
+                used_subnets.append(IPNetwork(subnet))
+
+            for pending in smart:
+                vlan_id = next((vlan for vlan in xrange(2, 4096) if vlan not in used_vlans), None)
+                subnet = next((candidate for candidate in
+                               IPNetwork(self.dc.TENANT_NET).subnet(int(pending.mask_bits))
+                               if not any(candidate.first <= used.last and used.first <= candidate.last
+                                          for used in used_subnets)), None)
+                if vlan_id is None or subnet is None:
+                    pending.fail(Exception('No free VLAN or subnet left for network %s' %
+                                           pending.params.get('name')))
+                    continue
+                used_vlans.add(vlan_id)
+                used_subnets.append(subnet)
+                with self._lock:
+                    self._reserved[pending] = (vlan_id, subnet.__str__())
+                pending.params.update({'subnet': subnet.__str__(),
+                                       'provision_start_ip': subnet[1].__str__(),
+                                       'provision_end_ip': subnet[-2].__str__(),
+                                       'nic_tag': self.dc.TENANT_NIC_TAG,
+                                       'vlan_id': vlan_id})
+
+
+def user_script_digest(user_script):
+    '''
+    returns the sha1 hex digest of a user-script, used to detect unchanged scripts without comparing them
+    '''
+    if isinstance(user_script, unicode):
+        user_script = user_script.encode('utf-8')
+    return hashlib.sha1(user_script or '').hexdigest()
+
+
+class MachineSnapshot(object):
+    '''
+    Immutable record of the parts of a VMAPI VM the plugin reads
+
+    Caches hold these instead of sdcadmin Machine objects with the whole VM payload, nics is a tuple of
+    (ip, nic_tag, network_uuid) tuples in VMAPI order and metadata_digest the user_script_digest of the user-script
+    in customer_metadata. The IPs are indexed by nic tag and by network once, when the snapshot is built.
+    '''
+
+    __slots__ = ('uuid', 'state', 'brand', 'nics', 'ips_by_tag', 'ips_by_network', 'metadata_digest')
+
+    def __init__(self, uuid, state=None, brand=None, nics=(), metadata_digest=None):
+        self.uuid = uuid
+        self.state = state
+        self.brand = brand
+        self.nics = tuple(nics)
+        self.metadata_digest = metadata_digest
+        ips_by_tag = {}
+        ips_by_network = {}
+        for ip, nic_tag, network_uuid in self.nics:
+            if ip:
+                ips_by_tag.setdefault(nic_tag, []).append(ip)
+                ips_by_network.setdefault(network_uuid, []).append(ip)
+        self.ips_by_tag = dict((nic_tag, tuple(ips)) for nic_tag, ips in ips_by_tag.items())
+        self.ips_by_network = dict((network_uuid, tuple(ips)) for network_uuid, ips in ips_by_network.items())
+
+    @classmethod
+    def from_vm(cls, vm):
+        '''
+        builds a snapshot from a VMAPI VM record
+        '''
+        return cls(vm.get('uuid'),
+                   state=vm.get('state'),
+                   brand=vm.get('brand'),
+                   nics=[(nic.get('ip'), nic.get('nic_tag'), nic.get('network_uuid')) for nic in vm.get('nics') or []],
+                   metadata_digest=user_script_digest((vm.get('customer_metadata') or {}).get('user-script')))
+
+    @property
+    def primary_ip(self):
+        if self.nics:
+            return self.nics[0][0]
+
+    def ips(self, nic_tag):
+        return list(self.ips_by_tag.get(nic_tag, ()))
+
+    def __repr__(self):
+        return '<MachineSnapshot %s %s>' % (self.uuid, self.state)
+
+
+class MetadataUpdateCoordinator(object):
+    '''
+    Rolls customer_metadata updates out to many machines
+
+    handle_update only queues the write. Writes that arrive within window seconds form one rolling update which
+    is applied in batches of [ROLLING_UPDATE] batch_size machines with at most max_in_flight concurrent requests.
+    After each batch one bulk VMAPI query (GET /vms?uuids=...&fields=uuid,customer_metadata) records the
+    user-script digest of all its machines, check_update_complete reads those digests and only machines that
+    are not confirmed yet are queried again, together, at most every confirm_interval seconds.
+    '''
+
+    def __init__(self, dc, window=ROLLING_UPDATE_WINDOW, confirm_interval=ROLLING_UPDATE_CONFIRM_INTERVAL):
+        self.dc = dc
+        self.window = window
+        self.confirm_interval = confirm_interval
+        self._queue = []
+        self._pending = set()
+        self._errors = {}
+        self._digests = {}
+        self._unconfirmed = set()
+        self._confirmed_at = 0
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        self._confirm_lock = threading.Lock()
+
+    def submit(self, vm_uuid, metadata):
+        with self._lock:
+            self._queue.append((vm_uuid, metadata))
+            self._pending.add(vm_uuid)
+            self._errors.pop(vm_uuid, None)
+            self._digests.pop(vm_uuid, None)
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                eventlet.spawn_after(self.window, self._flush)
+
+    def is_applied(self, vm_uuid, digest):
+        '''
+        checks whether VMAPI returns the user-script with the given digest for a machine
+        raises the error of a failed write
+        '''
+        with self._lock:
+            if vm_uuid in self._errors:
+                raise self._errors.pop(vm_uuid)
+            if vm_uuid in self._pending:
+                return False
+            if self._digests.get(vm_uuid) == digest:
+                return True
+            self._unconfirmed.add(vm_uuid)
+        self._confirm()
+        with self._lock:
+            return self._digests.get(vm_uuid) == digest
+
+    def forget(self, vm_uuid):
+        with self._lock:
+            self._digests.pop(vm_uuid, None)
+            self._unconfirmed.discard(vm_uuid)
+
+    def _flush(self):
+        with self._lock:
+            queue = self._queue
+            self._queue = []
+            self._flush_scheduled = False
+
+        cfg = get_config()
+        logger.debug("rolling user-script update of %i machines in batches of %i" % (len(queue), cfg.batch_size))
+        pool = eventlet.GreenPool(cfg.max_in_flight)
+        for i in range(0, len(queue), cfg.batch_size):
+            batch = queue[i:i + cfg.batch_size]
+            for update in batch:
+                pool.spawn_n(self._write, update)
+            pool.waitall()
+            batch_uuids = [vm_uuid for vm_uuid, metadata in batch]
+            with self._lock:
+                written = [vm_uuid for vm_uuid in batch_uuids if vm_uuid not in self._errors]
+            self._fetch_digests(written)
+            with self._lock:
+                self._pending.difference_update(batch_uuids)
+
+    def _write(self, update):
+        vm_uuid, metadata = update
+        try:
+            raw_job_data, response = self.dc.request('POST', 'vmapi', '/vms/%s/customer_metadata' % vm_uuid,
+                                                     data=metadata)
+            response.raise_for_status()
+        except Exception as e:
+            logger.error(_("Updating metadata of server %s failed: %s") % (vm_uuid, e))
+            with self._lock:
+                self._errors[vm_uuid] = e
+
+    def _fetch_digests(self, vm_uuids):
+        try:
+            digests = self.dc.get_user_script_digests(vm_uuids)
+        except Exception as e:
+            logger.warning("Bulk metadata query failed: %s" % e)
+            return
+        with self._lock:
+            self._digests.update(digests)
+            self._unconfirmed.difference_update(digests)
+
+    def _confirm(self):
+        with self._confirm_lock:
+            if time.time() - self._confirmed_at < self.confirm_interval:
+                return
+            with self._lock:
+                vm_uuids = list(self._unconfirmed)
+            self._fetch_digests(vm_uuids)
+            self._confirmed_at = time.time()
+
+
+class TeardownCoordinator(object):
+    '''
+    Deletes the machines and networks of stacks that are torn down
+
+    Machine deletes that arrive within window seconds are sent by a pool of concurrency greenthreads, the
+    VMStatusPoller then tracks their destruction with bulk status queries. A network is only deleted once NAPI
+    lists no NICs in it anymore, checked at most every check_interval seconds per network, so networks whose
+    machines are still being destroyed do not fail their delete over and over. A network that still has NICs
+    after release_timeout seconds, e.g. of machines outside the stack, fails its delete.
+    '''
+
+    def __init__(self, dc, window=TEARDOWN_WINDOW, concurrency=TEARDOWN_CONCURRENCY,
+                 check_interval=NETWORK_RELEASE_CHECK_INTERVAL, release_timeout=NETWORK_RELEASE_TIMEOUT):
+        self.dc = dc
+        self.window = window
+        self.concurrency = concurrency
+        self.check_interval = check_interval
+        self.release_timeout = release_timeout
+        self._queue = []
+        self._pending = set()
+        self._errors = {}
+        self._networks = {}
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+
+    def delete_machines(self, vm_uuids):
+        with self._lock:
+            for vm_uuid in vm_uuids:
+                self._queue.append(vm_uuid)
+                self._pending.add(vm_uuid)
+                self._errors.pop(vm_uuid, None)
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                eventlet.spawn_after(self.window, self._flush)
+
+    def is_sent(self, vm_uuid):
+        '''
+        checks whether the delete of a machine was accepted by VMAPI, raises the error of a failed delete
+        '''
+        with self._lock:
+            if vm_uuid in self._errors:
+                raise self._errors.pop(vm_uuid)
+            return vm_uuid not in self._pending
+
+    def _flush(self):
+        with self._lock:
+            queue = self._queue
+            self._queue = []
+            self._flush_scheduled = False
+
+        logger.debug("deleting %i machines" % len(queue))
+        pool = eventlet.GreenPool(self.concurrency)
+        for vm_uuid in queue:
+            pool.spawn_n(self._delete, vm_uuid)
+        pool.waitall()
+
+    def _delete(self, vm_uuid):
+        try:
+            self.dc.machine_action(vm_uuid, 'delete')
+        except requests.HTTPError as e:
+            # already gone
+            if e.response is None or e.response.status_code != 404:
+                logger.error(_("Deleting server %s failed: %s") % (vm_uuid, e))
+                with self._lock:
+                    self._errors[vm_uuid] = e
+        except Exception as e:
+            logger.error(_("Deleting server %s failed: %s") % (vm_uuid, e))
+            with self._lock:
+                self._errors[vm_uuid] = e
+        with self._lock:
+            self._pending.discard(vm_uuid)
+
+    def release_network(self, network_uuid):
+        with self._lock:
+            self._networks[network_uuid] = {'released_at': time.time(), 'checked_at': 0}
+
+    def network_released(self, network_uuid):
+        '''
+        deletes a network once no NICs are left in it
+        :return: True if the network is deleted
+        '''
+        now = time.time()
+        with self._lock:
+            # a release started before an engine restart is timed from the first check
+            release = self._networks.setdefault(network_uuid, {'released_at': now, 'checked_at': 0})
+            if now - release['checked_at'] < self.check_interval:
+                return False
+            release['checked_at'] = now
+
+        nics, response = self.dc.request('GET', 'napi', '/nics', params={'network_uuid': network_uuid})
+        response.raise_for_status()
+        if nics:
+            logger.debug("network %s still has %i nics" % (network_uuid, len(nics)))
+            if now - release['released_at'] >= self.release_timeout:
+                with self._lock:
+                    self._networks.pop(network_uuid, None)
+                raise Exception('Network %s still has %i nics after %is' %
+                                (network_uuid, len(nics), self.release_timeout))
+            return False
+
+        raw_data, response = self.dc.request('DELETE', 'napi', '/networks/%s' % network_uuid)
+        if response.status_code != 404:
+            response.raise_for_status()
+        with self._lock:
+            self._networks.pop(network_uuid, None)
+        return True
+
+
+class CatalogCache(object):
+    '''
+    UUIDs of the packages, images and networks of a datacenter, used to validate templates
+
+    The catalog is listed in bulk from PAPI, IMGAPI and NAPI on first use. Once it is older than ttl seconds a
+    background greenthread lists it again while the stale catalog keeps answering. A UUID that is not in the
+    catalog triggers a synchronous refresh (at most every miss_refresh_interval seconds) and then a direct
+    lookup, so objects created since the last refresh or cut off by a listing limit are not rejected.
+    '''
+
+    KINDS = {'package': ('papi', '/packages'),
+             'image': ('imgapi', '/images'),
+             'network': ('napi', '/networks')}
+
+    def __init__(self, dc, ttl=CATALOG_TTL, miss_refresh_interval=CATALOG_MISS_REFRESH_INTERVAL):
+        self.dc = dc
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self._uuids = {}
+        self._loaded_at = 0
+        self._miss_refreshed_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def _load(self):
+        uuids = {}
+        for kind, (api, path) in self.KINDS.items():
+            records, response = self.dc.request('GET', api, path)
+            response.raise_for_status()
+            uuids[kind] = set(record.get('uuid') for record in records or [])
+        logger.debug("loaded catalog of %s" % ', '.join('%i %ss' % (len(uuids[kind]), kind) for kind in uuids))
+        with self._lock:
+            self._uuids = uuids
+            self._loaded_at = time.time()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self._load()
+            except Exception as e:
+                logger.warning("Refreshing the catalog failed: %s" % e)
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        eventlet.spawn_n(refresh)
+
+    def _known(self, kind, uuid):
+        with self._lock:
+            return uuid in self._uuids.get(kind, ())
+
+    def _exists(self, kind, uuid):
+        api, path = self.KINDS[kind]
+        data, response = self.dc.request('GET', api, '%s/%s' % (path, uuid))
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        with self._lock:
+            self._uuids.setdefault(kind, set()).add(uuid)
+        return True
+
+    def contains(self, kind, uuid):
+        '''
+        checks whether a package, image or network exists
+        :param kind: package, image or network
+        :param uuid: uuid to look for
+        '''
+        with self._load_lock:
+            if not self._loaded_at:
+                self._load()
+        if time.time() - self._loaded_at >= self.ttl:
+            self._refresh_in_background()
+        if self._known(kind, uuid):
+            return True
+        with self._load_lock:
+            if time.time() - self._miss_refreshed_at >= self.miss_refresh_interval:
+                self._miss_refreshed_at = time.time()
+                self._load()
+        if self._known(kind, uuid):
+            return True
+        return self._exists(kind, uuid)
+
+
+class ImagePrefetcher(object):
+    '''
+    Imports the images of a stack into IMGAPI before its machines are created
+
+    The first machine of a stack that is created collects the distinct image/package pairs of all SDC::Compute
+    resources of the stack. Images IMGAPI does not have yet are imported from [PREFETCH] prefetch_source with
+    import-remote, prefetch_concurrency at a time, and the packages are looked up in the catalog. Every machine then
+    waits until its own image is active instead of each provisioning job downloading it.
+    '''
+
+    def __init__(self, dc, poll_interval=IMAGE_IMPORT_POLL_INTERVAL):
+        self.dc = dc
+        self.poll_interval = poll_interval
+        self._stacks = TTLCache(ATTRIBUTE_CACHE_SIZE, CATALOG_TTL)
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def prefetch_stack(self, stack_id, get_pairs):
+        '''
+        starts the prefetch of a stack, later calls for the same stack do nothing
+        :param stack_id: id of the stack
+        :param get_pairs: callable returning the set of (image, package) pairs of the stack
+        '''
+        with self._lock:
+            if self._stacks.get(stack_id):
+                return
+            self._stacks.set(stack_id, True)
+
+        pairs = get_pairs()
+        images = set(image for image, package in pairs)
+        packages = set(package for image, package in pairs if package)
+        with self._lock:
+            images = [image for image in images if image not in self._images]
+            for image in images:
+                self._images[image] = threading.Event()
+        logger.debug("prefetching %i images and %i packages of stack %s" % (len(images), len(packages), stack_id))
+
+        cfg = get_config()
+        pool = eventlet.GreenPool(cfg.prefetch_concurrency)
+        for image in images:
+            pool.spawn_n(self._import, image, cfg.prefetch_source, cfg.prefetch_timeout)
+        for package in packages:
+            pool.spawn_n(self._warm_package, package)
+
+    def wait(self, image_uuid, timeout):
+        '''
+        waits until an image that is being prefetched is imported
+        :return: False if the import did not finish within timeout
+        '''
+        with self._lock:
+            done = self._images.get(image_uuid)
+        if done is None:
+            return True
+        return done.wait(timeout)
+
+    def _get_image_state(self, image_uuid):
+        image, response = self.dc.request('GET', 'imgapi', '/images/%s' % image_uuid)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return image.get('state')
+
+    def _import(self, image_uuid, source, timeout):
+        succeeded = False
+        try:
+            state = self._get_image_state(image_uuid)
+            if state is None:
+                logger.debug("importing image %s from %s" % (image_uuid, source))
+                raw_job_data, response = self.dc.request('POST', 'imgapi', '/images/%s' % image_uuid,
+                                                         params={'action': 'import-remote', 'source': source})
+                response.raise_for_status()
+            deadline = time.time() + timeout
+            while state != 'active' and time.time() < deadline:
+                if state == 'failed':
+                    raise Exception('import failed')
+                eventlet.sleep(self.poll_interval)
+                state = self._get_image_state(image_uuid)
+            succeeded = state == 'active'
+        except Exception as e:
+            logger.warning("Prefetching image %s failed: %s" % (image_uuid, e))
+        finally:
+            with self._lock:
+                done = self._images[image_uuid]
+                # failed imports are tried again by the next stack
+                if not succeeded:
+                    del self._images[image_uuid]
+            done.set()
+
+    def _warm_package(self, package_uuid):
+        try:
+            self.dc.catalog.contains('package', package_uuid)
+        except Exception as e:
+            logger.warning("Looking up package %s failed: %s" % (package_uuid, e))
+
+
+class DataCenterPool(object):
+    '''
+    Process-wide registry of PooledDataCenter clients keyed by (sapi, vmapi) endpoint
+
+    The registry holds at most max_clients clients (least recently used ones are evicted first) and drops
+    clients that have not been used for idle_timeout seconds. The components of an evicted client stay
+    registered per endpoint and are handed to its successor. Heat runs the engine with eventlet monkey
+    patching, so the threading locks used here are greenthread-safe.
+    '''
+
+    def __init__(self, max_clients=DC_POOL_MAX_CLIENTS, idle_timeout=DC_POOL_IDLE_TIMEOUT):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()
+        self._components = {}
+        self._creation_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sapi_endpoint, vmapi_endpoint):
+        key = (sapi_endpoint, vmapi_endpoint)
+        with self._lock:
+            self._evict_idle()
+            dc = self._checkout(key)
+            if dc is not None:
+                self.hits += 1
+                return dc
+            creation_lock = self._creation_locks.setdefault(key, threading.Lock())
+
+        # only one greenthread per endpoint builds the client, the others wait and reuse it
+        with creation_lock:
+            with self._lock:
+                dc = self._checkout(key)
+                if dc is not None:
+                    self.hits += 1
+                    return dc
+                self.misses += 1
+                components = self._components.setdefault(key, {})
+            logger.debug("creating pooled DataCenter for sapi: %s, vmapi: %s" % key)
+            dc = PooledDataCenter(sapi=sapi_endpoint, vmapi=vmapi_endpoint, components=components)
+            with self._lock:
+                self._clients[key] = (dc, time.time())
+                self._creation_locks.pop(key, None)
+                while len(self._clients) > self.max_clients:
+                    _, (evicted, _) = self._clients.popitem(last=False)
+                    evicted.close()
+                    self.evictions += 1
+        return dc
+
+    def _checkout(self, key):
+        entry = self._clients.pop(key, None)
+        if entry is None:
+            return None
+        self._clients[key] = (entry[0], time.time())
+        return entry[0]
+
+    def _evict_idle(self):
+        deadline = time.time() - self.idle_timeout
+        for key, (dc, last_used) in self._clients.items():
+            if last_used < deadline:
+                del self._clients[key]
+                dc.close()
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for dc, _ in self._clients.values():
+                dc.close()
+            self._clients.clear()
+            self._components.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._clients),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+dc_pool = DataCenterPool()
+
+
+
+class TTLCache(object):
+    '''
+    LRU-bounded cache whose entries expire ttl seconds after they were stored
+    '''
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.time() - stored_at >= self.ttl:
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# MachineSnapshots and network records used to resolve attributes, keyed by uuid
+machine_cache = TTLCache(ATTRIBUTE_CACHE_SIZE, ATTRIBUTE_CACHE_TTL)
+network_cache = TTLCache(ATTRIBUTE_CACHE_SIZE, ATTRIBUTE_CACHE_TTL)
+
+
+class ReadinessScheduler(object):
+    '''
+    Decides when a check_*_complete should actually ask for the state of a VM
+
+    Durations of finished operations are learned per (operation, brand, package) as an exponentially weighted
+    moving average. A running operation is not polled before early_fraction of its estimated duration has
+    passed, after that every miss backs off exponentially with jitter. Only a state VMAPI returned after the last
+    miss counts as a new miss, reads served from the VMStatusPoller cache do not. Once an estimate exists the
+    delay is capped at a quarter of it, so completion is still noticed soon after it happens. Operations nobody
+    asked about for max_delay * stale_factor seconds (failed or abandoned ones) are dropped.
+    '''
+
+    def __init__(self, initial_delay=READINESS_INITIAL_DELAY, max_delay=READINESS_MAX_DELAY,
+                 early_fraction=READINESS_EARLY_FRACTION, smoothing=READINESS_SMOOTHING,
+                 stale_factor=READINESS_STALE_FACTOR):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.early_fraction = early_fraction
+        self.smoothing = smoothing
+        self.stale_after = max_delay * stale_factor
+        self._estimates = {}
+        self._pending = {}
+        self._pruned_at = time.time()
+        self._lock = threading.Lock()
+
+    def start(self, vm_uuid, operation, brand, package):
+        key = (operation, brand, package)
+        now = time.time()
+        with self._lock:
+            estimate = self._estimates.get(key)
+            first_poll = now + estimate * self.early_fraction if estimate else now
+            self._pending[vm_uuid] = {'key': key, 'started': now, 'next_poll': first_poll, 'attempts': 0,
+                                      'seen': now, 'fetched_at': now}
+            if now - self._pruned_at >= self.max_delay:
+                self._prune(now)
+
+    def due(self, vm_uuid):
+        # operations started before an engine restart are unknown and always polled
+        now = time.time()
+        with self._lock:
+            pending = self._pending.get(vm_uuid)
+            if pending is None:
+                return True
+            pending['seen'] = now
+            return now >= pending['next_poll']
+
+    def missed(self, vm_uuid, fetched_at):
+        '''
+        backs off after VMAPI returned a state other than the expected one
+        :param fetched_at: when the state was fetched from VMAPI, see VMStatusPoller.fetched_at
+        '''
+        with self._lock:
+            pending = self._pending.get(vm_uuid)
+            if pending is None or fetched_at is None or fetched_at <= pending['fetched_at']:
+                return
+            pending['fetched_at'] = fetched_at
+            pending['attempts'] += 1
+            max_delay = self.max_delay
+            estimate = self._estimates.get(pending['key'])
+            if estimate:
+                max_delay = max(self.initial_delay, min(max_delay, estimate / 4.0))
+            delay = min(max_delay, self.initial_delay * 2 ** (pending['attempts'] - 1))
+            delay = random.uniform(delay / 2.0, delay)
+            pending['next_poll'] = time.time() + delay
+
+    def cancel(self, vm_uuid):
+        with self._lock:
+            self._pending.pop(vm_uuid, None)
+
+    def finished(self, vm_uuid):
+        with self._lock:
+            pending = self._pending.pop(vm_uuid, None)
+            if pending is None:
+                return
+            duration = time.time() - pending['started']
+            estimate = self._estimates.get(pending['key'])
+            if estimate is None:
+                self._estimates[pending['key']] = duration
+            else:
+                self._estimates[pending['key']] = (1 - self.smoothing) * estimate + self.smoothing * duration
+            logger.debug("%s took %.1fs, estimate for %s is now %.1fs" %
+                         (vm_uuid, duration, pending['key'], self._estimates[pending['key']]))
+
+    def _prune(self, now):
+        for vm_uuid, pending in self._pending.items():
+            if now - pending['seen'] > self.stale_after:
+                del self._pending[vm_uuid]
+        self._pruned_at = now
+
+
+readiness_scheduler = ReadinessScheduler()
+
+
+class KeypairCache(object):
+    '''
+    Public keys of the nova keypairs of a user, shared by all machine resources
+
+    Concurrent lookups for the same user wait for a single nova call, the keys are listed again after the TTL.
+    '''
+
+    def __init__(self, ttl=KEYPAIR_CACHE_TTL, maxsize=ATTRIBUTE_CACHE_SIZE):
+        self._cache = TTLCache(maxsize, ttl)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, user, list_keypairs):
+        public_keys = self._cache.get(user)
+        if public_keys is not None:
+            return public_keys
+        with self._lock:
+            user_lock = self._locks.setdefault(user, threading.Lock())
+        with user_lock:
+            public_keys = self._cache.get(user)
+            if public_keys is not None:
+                return public_keys
+            public_keys = [key.public_key for key in list_keypairs()]
+            self._cache.set(user, public_keys)
+            return public_keys
+
+
+keypair_cache = KeypairCache()
 
 
 class SDCNetwork(resource.Resource):
@@ -94,7 +1729,7 @@ class SDCNetwork(resource.Resource):
         NIC_TAG: properties.Schema(
             properties.Schema.STRING,
             _('NIC Tag for the new network.'),
-            required=not override_nic_tag,
+            required=not sdc_config.override_nic_tag,
             default='customer'
         ),
         GATEWAY: properties.Schema(
@@ -128,7 +1763,7 @@ class SDCNetwork(resource.Resource):
             default=''
         )
     }
-    if not override_endpoints:
+    if not sdc_config.override_endpoints:
         properties_schema.update({
             SAPI_ENDPOINT: properties.Schema(
             properties.Schema.STRING,
@@ -141,12 +1776,12 @@ class SDCNetwork(resource.Resource):
                 required = True
             )
         })
-    if not override_owner:
+    if not sdc_config.override_owner:
         properties_schema.update({
             OWNER_UUIDS: properties.Schema(
                 properties.Schema.STRING,
                 _('UUIDs of the new network, comma separated.'),
-                required=not override_owner
+                required=not sdc_config.override_owner
             )
         })
 
@@ -155,26 +1790,30 @@ class SDCNetwork(resource.Resource):
     }
 
     def _get_dc(self):
-        if override_endpoints:
-            sapi_endpoint = override_sapi_endpoint
-            vmapi_endpoint = override_vmapi_endpoint
+        cfg = get_config()
+        if cfg.override_endpoints:
+            sapi_endpoint = cfg.override_sapi_endpoint
+            vmapi_endpoint = cfg.override_vmapi_endpoint
         else:
             sapi_endpoint = self.properties.get(self.SAPI_ENDPOINT)
             vmapi_endpoint = self.properties.get(self.VMAPI_ENDPOINT)
 
-
-
-        dc = DataCenter(sapi=sapi_endpoint, vmapi=vmapi_endpoint)
+        dc = dc_pool.get(sapi_endpoint, vmapi_endpoint)
+        admission_controller.set_stack(self.stack.id)
         # TODO: add grace period, i.e. retries=3
         # if dc.healthcheck_vmapi() != True:
         #     raise Exception('VMAPI not healthy')
         return dc
 
+    def _get_network_record(self):
+        return network_cache.get_or_load(self.resource_id, lambda: self._get_dc().get_network(self.resource_id))
+
     def _resolve_attribute(self, name):
 
-        dc = self._get_dc()
         logger.debug("lookup for %s, resource_id: %s" % (name, self.resource_id))
-        network = dc.get_network(self.resource_id)
+        if self.resource_id is None:
+            return None
+        network = self._get_network_record()
         logger.debug("network: %s" % network)
         if network:
             return getattr(network, name)
@@ -183,9 +1822,10 @@ class SDCNetwork(resource.Resource):
 
         dc = self._get_dc()
 
+        cfg = get_config()
         sapi_endpoint = self.properties.get(self.SAPI_ENDPOINT)
-        if override_owner:
-            owner_uuids = override_owner_uuid
+        if cfg.override_owner:
+            owner_uuids = cfg.override_owner_uuid
         else:
             owner_uuids = self.properties.get(self.OWNER_UUIDS)
         name = self.properties.get(self.NAME)
@@ -193,8 +1833,8 @@ class SDCNetwork(resource.Resource):
         provision_start = self.properties.get(self.PROVISION_START)
         provision_end = self.properties.get(self.PROVISION_END)
 
-        if override_nic_tag:
-            nic_tag = override_nic_tag_name
+        if cfg.override_nic_tag:
+            nic_tag = cfg.override_nic_tag_name
         else:
             nic_tag = self.properties.get(self.NIC_TAG)
         gateway = self.properties.get(self.GATEWAY)
@@ -222,14 +1862,42 @@ class SDCNetwork(resource.Resource):
                        "routes: %s, "
                        "description: %s") % (sapi_endpoint, owner_uuids, name, subnet, provision_start, provision_end,
                                          nic_tag, gateway, vlan, resolvers, routes, description))
-        network = dc.create_network(name, owner_uuids, subnet, provision_start, provision_end, nic_tag, gateway, vlan,
-                                    resolvers, routes,  description)
-
-        logger.debug(_("Network created %s") % network)
-
+        pending = dc.network_provisioner.submit({'name': name,
+                                                 'owner_uuids': owner_uuids,
+                                                 'subnet': subnet,
+                                                 'provision_start_ip': provision_start,
+                                                 'provision_end_ip': provision_end,
+                                                 'nic_tag': nic_tag,
+                                                 'gateway': gateway,
+                                                 'vlan_id': vlan,
+                                                 'resolvers': resolvers,
+                                                 'routes': routes,
+                                                 'description': description},
+                                                on_created=self._network_created)
+
+        return pending
+
+    def _network_created(self, network):
+        # recorded right away, so a stack deleted before check_create_complete still deletes the network
         self.resource_id_set(network.uuid)
 
-        return network.uuid
+    def check_create_complete(self, pending):
+
+        if self.resource_id is None:
+            if not pending.ready():
+                logger.debug(_("Network %s not yet created") % pending.params.get('name'))
+                return False
+            network = pending.wait()
+            logger.debug(_("Network created %s") % network)
+            self.resource_id_set(network.uuid)
+
+        # NAPI has to return the new network before machines can be attached to it
+        network = self._get_dc().get_network(self.resource_id)
+        if not network:
+            logger.debug(_("Network %s not yet available") % self.resource_id)
+            return False
+        network_cache.set(self.resource_id, network)
+        return True
 
 
     def handle_delete(self):
@@ -242,12 +1910,17 @@ class SDCNetwork(resource.Resource):
             logger.debug(_("Delete: resource_id is empty - nothing to do, exiting."))
             return
 
-        network = dc.get_network(self.resource_id)
+        network_cache.invalidate(self.resource_id)
+        dc.teardown.release_network(self.resource_id)
+        return self.resource_id
 
-        if network == None:
+    def check_delete_complete(self, network_uuid):
+        if not network_uuid:
             return True
+        dc = self._get_dc()
 
-        network.delete()
+        logger.debug(_("Check delete network %s") % network_uuid)
+        return dc.teardown.network_released(network_uuid)
 
 
 class SDCSmartNetwork(SDCNetwork):
@@ -276,7 +1949,7 @@ class SDCSmartNetwork(SDCNetwork):
             default=''
         )
     }
-    if not override_endpoints:
+    if not sdc_config.override_endpoints:
         properties_schema.update({
             SAPI_ENDPOINT: properties.Schema(
             properties.Schema.STRING,
@@ -289,12 +1962,12 @@ class SDCSmartNetwork(SDCNetwork):
                 required = True
             )
         })
-    if not override_owner:
+    if not sdc_config.override_owner:
         properties_schema.update({
             OWNER_UUIDS: properties.Schema(
                 properties.Schema.STRING,
                 _('UUIDs of the new network, comma separated.'),
-                required=not override_owner
+                required=not sdc_config.override_owner
             )
         })
 
@@ -304,12 +1977,13 @@ class SDCSmartNetwork(SDCNetwork):
 
 
 
+        cfg = get_config()
         sapi_endpoint = self.properties.get(self.SAPI_ENDPOINT)
-        if override_owner:
-            if real_owner:
+        if cfg.override_owner:
+            if cfg.real_owner:
                 owner_uuids = self.keystone()._client.user_id
             else:
-                owner_uuids = override_owner_uuid
+                owner_uuids = cfg.override_owner_uuid
         else:
             owner_uuids = self.properties.get(self.OWNER_UUIDS)
         name = self.properties.get(self.NAME) + '.' + uuid.uuid4().__str__()
@@ -322,13 +1996,12 @@ class SDCSmartNetwork(SDCNetwork):
                        "name: %s, "
                        "mask_bits: %s, "
                        "description: %s") % (sapi_endpoint, owner_uuids, name, mask_bits, description))
-        network = dc.create_smart_network(name, owner_uuids, mask_bits=mask_bits, description=description)
+        pending = dc.network_provisioner.submit({'name': name,
+                                                 'owner_uuids': owner_uuids,
+                                                 'description': description},
+                                                mask_bits=mask_bits, on_created=self._network_created)
 
-        logger.debug(_("Network created %s") % network)
-
-        self.resource_id_set(network.uuid)
-
-        return network.uuid
+        return pending
 
 
 class SDCMachine(resource.Resource):
@@ -369,7 +2042,7 @@ class SDCMachine(resource.Resource):
 
     }
 
-    if not override_endpoints:
+    if not sdc_config.override_endpoints:
         properties_schema.update({
             SAPI_ENDPOINT: properties.Schema(
             properties.Schema.STRING,
@@ -382,7 +2055,7 @@ class SDCMachine(resource.Resource):
                 required = True
             )
         })
-    if not override_owner:
+    if not sdc_config.override_owner:
         properties_schema.update({
             USER_UUID: properties.Schema(
                 properties.Schema.STRING,
@@ -392,56 +2065,220 @@ class SDCMachine(resource.Resource):
         })
 
     def _get_dc(self):
-        if override_endpoints:
-            sapi_endpoint = override_sapi_endpoint
-            vmapi_endpoint = override_vmapi_endpoint
+        cfg = get_config()
+        if cfg.override_endpoints:
+            sapi_endpoint = cfg.override_sapi_endpoint
+            vmapi_endpoint = cfg.override_vmapi_endpoint
         else:
             sapi_endpoint = self.properties.get(self.SAPI_ENDPOINT)
             vmapi_endpoint = self.properties.get(self.VMAPI_ENDPOINT)
 
-
-
-        dc = DataCenter(sapi=sapi_endpoint, vmapi=vmapi_endpoint)
+        dc = dc_pool.get(sapi_endpoint, vmapi_endpoint)
+        admission_controller.set_stack(self.stack.id)
         # TODO: add grace period, i.e. retries=3
         # if dc.healthcheck_vmapi() != True:
         #     raise Exception('VMAPI not healthy')
         return dc
 
-    def _resolve_attribute(self, name):
+    def _get_machine_record(self, vm_uuid=None):
+        vm_uuid = vm_uuid or self.resource_id
+        return machine_cache.get_or_load(vm_uuid, lambda: self._get_dc().get_machine_snapshot(vm_uuid))
+
+    def _get_machine_records(self, vm_uuids):
+        '''
+        returns MachineSnapshots in the order of vm_uuids, the ones not cached are fetched together
+        '''
+        snapshots = dict((vm_uuid, machine_cache.get(vm_uuid)) for vm_uuid in vm_uuids)
+        missing = [vm_uuid for vm_uuid, snapshot in snapshots.items() if snapshot is None]
+        if missing:
+            for vm_uuid, snapshot in self._get_dc().get_machine_snapshots(missing).items():
+                machine_cache.set(vm_uuid, snapshot)
+                snapshots[vm_uuid] = snapshot
+        return [snapshots.get(vm_uuid) for vm_uuid in vm_uuids]
+
+    @staticmethod
+    def _nic_ips(machine, nic_tag):
+        return ','.join(machine.ips(nic_tag))
+
+    @staticmethod
+    def _internal_nic_tag():
+        cfg = get_config()
+        if cfg.override_nic_tag:
+            return cfg.override_nic_tag_name
+        return DataCenter.TENANT_NIC_TAG
+
+    @staticmethod
+    def _ips_map(index):
+        return dict((key, list(ips)) for key, ips in index.items())
 
-        dc = self._get_dc()
+    def _resolve_attribute(self, name):
 
-        machine = dc.get_machine(self.resource_id)
+        if self.resource_id is None:
+            return None
+        machine = self._get_machine_record()
         if machine:
             if name == 'network_ip':
-                return machine.nics[0].get('ip')
+                return machine.primary_ip
             if name == 'external_ip':
-                try:
-                    return ','.join([nic.get('ip') for nic in machine.nics if nic.get('nic_tag') == 'external'])
-                except:
-                    return ''
+                return self._nic_ips(machine, EXTERNAL_NIC_TAG)
             if name == 'internal_ip':
-                 try:
-                    return ','.join([nic.get('ip') for nic in machine.nics if nic.get('nic_tag') == 'customer'])
-                 except:
-                    return ''
-            return getattr(machine, name)
+                return self._nic_ips(machine, self._internal_nic_tag())
+            if name == 'ips_by_network':
+                return self._ips_map(machine.ips_by_network)
+            if name == 'ips_by_tag':
+                return self._ips_map(machine.ips_by_tag)
+            return getattr(machine, name, None)
 
     attributes_schema = {
         'network_ip': _('ip address'),
         'external_ip': _('external ip address'),
-        'internal_ip': _('internal ip address')
+        'internal_ip': _('internal ip address'),
+        'ips_by_network': _('map of network uuid to the ip addresses in that network'),
+        'ips_by_tag': _('map of nic tag to the ip addresses with that nic tag')
     }
 
-    # def handle_create(self): <- is handled in SDCSmartMachine and SDCKVM
+    brand = None
+
+    def validate(self):
+        '''
+        checks that package, image and networks exist before anything is created
+
+        values that are not UUIDs, e.g. references to resources that are not created yet, are not checked
+        '''
+        result = super(SDCMachine, self).validate()
+        if result:
+            return result
+
+        checks = [('package', self.properties.get(self.PACKAGE))]
+        # prefetched images are imported on create, they need not be in IMGAPI yet
+        if not get_config().prefetch_images:
+            checks.append(('image', self.properties.get(self.IMAGE)))
+        networks = self.properties.get(self.NETWORKS)
+        if networks:
+            checks.extend(('network', network.strip()) for network in networks.split(','))
+        checks = [(kind, value) for kind, value in checks if value is not None and UUID_PATTERN.match(value)]
+        if not checks:
+            return
+
+        try:
+            dc = self._get_dc()
+            missing = [(kind, value) for kind, value in checks if not dc.catalog.contains(kind, value)]
+        except Exception as e:
+            logger.warning(_("Could not validate %s against SDC: %s") % (self.name, e))
+            return
+        if missing:
+            raise exception.StackValidationFailed(
+                message=_("%s: %s not found in SDC") % (self.name, ', '.join('%s %s' % m for m in missing)))
+
+    def _get_owner_uuid(self):
+        cfg = get_config()
+        if cfg.override_owner:
+            if cfg.real_owner:
+                return self.keystone()._client.user_id
+            return cfg.override_owner_uuid
+        return self.properties.get(self.USER_UUID)
+
+    def _get_ssh_keys(self):
+        ssh_keys = False
+        if not get_config().real_owner:
+            ssh_keys = []
+            user = getattr(self.context, 'user_id', None) or self.stack.id
+            try:
+                ssh_keys = list(keypair_cache.get(user, self.nova().keypairs.list))
+            except:
+                pass
+            if len(ssh_keys) == 0:
+                    ssh_keys = False
+        return ssh_keys
+
+    def _get_alias(self, suffix=''):
+        alias = self.properties.get(self.INSTANCE_ALIAS)
+        if alias:
+            # add stack id to avoid alias collisions
+            return alias + suffix + '-' + self.stack.id
+        return uuid.uuid4().__str__() + '-' + self.stack.id
+
+    # def _create_machine(self, dc, alias, ssh_keys): <- is handled in SDCSmartMachine and SDCKVM
+
+    def _stack_image_pairs(self):
+        pairs = set()
+        for res in self.stack.values():
+            if not isinstance(res, SDCMachine):
+                continue
+            try:
+                image = res.properties.get(res.IMAGE)
+                package = res.properties.get(res.PACKAGE)
+            except Exception as e:
+                logger.debug("Skipping %s in prefetch: %s" % (res.name, e))
+                continue
+            if image:
+                pairs.add((image, package))
+        return pairs
+
+    def _prefetch_image(self, dc):
+        cfg = get_config()
+        if not cfg.prefetch_images:
+            return
+        dc.image_prefetcher.prefetch_stack(self.stack.id, self._stack_image_pairs)
+        image = self.properties.get(self.IMAGE)
+        if not dc.image_prefetcher.wait(image, cfg.prefetch_timeout):
+            logger.warning(_("Image %s was not prefetched within %ss") % (image, cfg.prefetch_timeout))
+
+    def _vm_uuids(self):
+        return [self.resource_id]
+
+    def _for_each_vm(self, func):
+        pool = eventlet.GreenPool(MACHINE_ACTION_CONCURRENCY)
+        for _ in pool.imap(admission_controller.bind(func), self._vm_uuids()):
+            pass
+
+    def _watch(self, dc, operation):
+        for vm_uuid in self._vm_uuids():
+            dc.status_poller.watch(vm_uuid)
+            readiness_scheduler.start(vm_uuid, operation, self.brand, self.properties.get(self.PACKAGE))
+
+    def _check_vm_state(self, dc, *states):
+        complete = True
+        for vm_uuid in self._vm_uuids():
+            if not readiness_scheduler.due(vm_uuid):
+                complete = False
+                continue
+            state = dc.status_poller.get_state(vm_uuid)
+            if state in states:
+                readiness_scheduler.finished(vm_uuid)
+            elif state == DataCenter.STATE_FAILED and DataCenter.STATE_DESTROYED not in states:
+                # a failed VM never reaches the target state, only a delete still gets it somewhere
+                for watched_uuid in self._vm_uuids():
+                    dc.status_poller.unwatch(watched_uuid)
+                    readiness_scheduler.cancel(watched_uuid)
+                raise Exception('Server %s failed' % vm_uuid)
+            else:
+                readiness_scheduler.missed(vm_uuid, dc.status_poller.fetched_at(vm_uuid))
+                complete = False
+        if complete:
+            for vm_uuid in self._vm_uuids():
+                dc.status_poller.unwatch(vm_uuid)
+        return complete
+
+    def handle_create(self):
+
+        dc = self._get_dc()
+        self._prefetch_image(dc)
+
+        machine = self._create_machine(dc, self._get_alias(), self._get_ssh_keys())
+
+        self.resource_id_set(machine.uuid)
+        self.data_set('user_script_digest', user_script_digest(self.properties.get(self.USER_SCRIPT)))
+        self._watch(dc, 'create')
+
+        return machine.uuid
 
     def check_create_complete(self, _compute_id):
 
         dc = self._get_dc()
 
         logger.debug(_("Check create server %s") % self.resource_id)
-        machine = dc.get_machine(self.resource_id)
-        return machine.is_running()
+        return self._check_vm_state(dc, DataCenter.STATE_RUNNING)
 
     def handle_suspend(self):
         logger.debug(_("suspend server %s") % self.resource_id)
@@ -453,16 +2290,18 @@ class SDCMachine(resource.Resource):
             logger.debug(_("Suspend: resource_id is empty - nothing to do, exiting."))
             return
 
-        instance = dc.get_machine(self.resource_id)
+        def stop(vm_uuid):
+            machine_cache.invalidate(vm_uuid)
+            dc.machine_action(vm_uuid, 'stop')
 
-        instance.stop()
+        self._for_each_vm(stop)
+        self._watch(dc, 'suspend')
 
     def check_suspend_complete(self, _compute_id):
         dc = self._get_dc()
 
         logger.debug(_("Check suspend server %s") % self.resource_id)
-        machine = dc.get_machine(self.resource_id)
-        return machine.is_stopped()
+        return self._check_vm_state(dc, DataCenter.STATE_STOPPED)
 
     def handle_resume(self):
         logger.debug(_("resume server %s") % self.resource_id)
@@ -474,16 +2313,18 @@ class SDCMachine(resource.Resource):
             logger.debug(_("Resume: resource_id is empty - nothing to do, exiting."))
             return
 
-        instance = dc.get_machine(self.resource_id)
+        def start(vm_uuid):
+            machine_cache.invalidate(vm_uuid)
+            dc.machine_action(vm_uuid, 'start')
 
-        instance.start()
+        self._for_each_vm(start)
+        self._watch(dc, 'resume')
 
     def check_resume_complete(self, _compute_id):
         dc = self._get_dc()
 
         logger.debug(_("Check resuming server %s") % self.resource_id)
-        machine = dc.get_machine(self.resource_id)
-        return machine.is_running()
+        return self._check_vm_state(dc, DataCenter.STATE_RUNNING)
 
     def handle_delete(self):
         logger.debug(_("Delete server %s") % self.resource_id)
@@ -494,10 +2335,11 @@ class SDCMachine(resource.Resource):
             logger.debug(_("Delete: resource_id is empty - nothing to do, exiting."))
             return
 
-        logger.debug("Deleting machine with id %s" % self.resource_id)
-        instance = dc.get_machine(self.resource_id)
-
-        instance.delete()
+        for vm_uuid in self._vm_uuids():
+            logger.debug("Deleting machine with id %s" % vm_uuid)
+            machine_cache.invalidate(vm_uuid)
+        dc.teardown.delete_machines(self._vm_uuids())
+        self._watch(dc, 'delete')
 
     def check_delete_complete(self, _compute_id):
         dc = self._get_dc()
@@ -506,8 +2348,10 @@ class SDCMachine(resource.Resource):
         if self.resource_id is None:
             logger.debug(_("Delete: resource_id is empty - nothing to do, exiting."))
             return True
-        machine = dc.get_machine(self.resource_id)
-        return machine.is_destroyed()
+        for vm_uuid in self._vm_uuids():
+            if not dc.teardown.is_sent(vm_uuid):
+                return False
+        return self._check_vm_state(dc, DataCenter.STATE_DESTROYED, VMStatusPoller.STATE_UNKNOWN)
 
     def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
 
@@ -520,61 +2364,49 @@ class SDCMachine(resource.Resource):
 
         if self.USER_SCRIPT in prop_diff:
             new_user_script = prop_diff[self.USER_SCRIPT]
-            machine = dc.get_machine(self.resource_id)
-            logger.debug('Update server %s with new user-script: %s' % (self.resource_id, new_user_script))
-            customer_metadata = machine.customer_metadata
-            customer_metadata.update({'user-script': new_user_script, 'rerun-user-script': 'True'})
-            machine.update_metadata('customer_metadata', customer_metadata)
-            return customer_metadata
+            new_digest = user_script_digest(new_user_script)
+            if new_digest == self.data().get('user_script_digest'):
+                logger.debug(_("user-script of server %s is unchanged") % self.resource_id)
+                return None
+
+            for vm_uuid in self._vm_uuids():
+                machine_cache.invalidate(vm_uuid)
+                logger.debug('Update server %s with new user-script: %s' % (vm_uuid, new_user_script))
+                # merges the changed keys into the existing customer_metadata
+                dc.metadata_updater.submit(vm_uuid, {'user-script': new_user_script, 'rerun-user-script': 'True'})
+
+            # the digest is stored by check_update_complete once VMAPI returns the new user-script
+            return {'user-script-digest': new_digest}
         return None
 
     def check_update_complete(self, token):
+        if not token:
+            return True
         dc = self._get_dc()
         logger.debug(_("Check if update is complete"))
-        machine = dc.get_machine(self.resource_id)
-        if token.get('user-script') == machine.customer_metadata.get('user-script'):
-            logger.debug(_("user-script updated"))
-            return True
-        logger.debug(_("user-script not yet updated"))
-        return False
+        for vm_uuid in self._vm_uuids():
+            if not dc.metadata_updater.is_applied(vm_uuid, token.get('user-script-digest')):
+                logger.debug(_("user-script not yet updated"))
+                return False
+        for vm_uuid in self._vm_uuids():
+            dc.metadata_updater.forget(vm_uuid)
+        self.data_set('user_script_digest', token.get('user-script-digest'))
+        logger.debug(_("user-script updated"))
+        return True
 
 
 class SDCSmartMachine(SDCMachine):
 
-    def handle_create(self):
+    brand = 'joyent'
 
-        dc = self._get_dc()
+    def _create_machine(self, dc, alias, ssh_keys):
 
-        if override_owner:
-            if real_owner:
-                user_uuid = self.keystone()._client.user_id
-            else:
-                user_uuid = override_owner_uuid
-        else:
-            user_uuid = self.properties.get(self.USER_UUID)
+        user_uuid = self._get_owner_uuid()
         networks = self.properties.get(self.NETWORKS).split(',')
         package = self.properties.get(self.PACKAGE)
         image = self.properties.get(self.IMAGE)
-        alias = self.properties.get(self.INSTANCE_ALIAS)
         user_script = self.properties.get(self.USER_SCRIPT)
 
-        ssh_keys = False
-        if not real_owner:
-            ssh_keys = []
-            try:
-                for key in self.nova().keypairs.list():
-                    ssh_keys.append(key.public_key)
-            except:
-                pass
-            if len(ssh_keys) == 0:
-                    ssh_keys = False
-
-        if alias:
-            # add stack id to avoid alias collisions
-            alias = alias + '-' + self.stack.id
-        if not alias:
-            alias = uuid.uuid4().__str__() + '-' + self.stack.id
-
         logger.debug(_("Trying to create a Machine with "
                        "owner: %s, "
                        "networks: %s, "
@@ -594,44 +2426,27 @@ class SDCSmartMachine(SDCMachine):
                                           ssh_keys=ssh_keys)
         logger.debug(_("VM Created %s") % machine)
 
-        self.resource_id_set(machine.uuid)
-
-        return machine.uuid
+        return machine
 
 
 class SDCKVM(SDCMachine):
 
-    def handle_create(self):
+    brand = 'kvm'
 
-        dc = self._get_dc()
+    def _get_owner_uuid(self):
+        cfg = get_config()
+        if cfg.override_owner:
+            return cfg.override_owner_uuid
+        return self.properties.get(self.USER_UUID)
 
-        if override_owner:
-            user_uuid = override_owner_uuid
-        else:
-            user_uuid = self.properties.get(self.USER_UUID)
+    def _create_machine(self, dc, alias, ssh_keys):
+
+        user_uuid = self._get_owner_uuid()
         networks = self.properties.get(self.NETWORKS).split(',')
         package = self.properties.get(self.PACKAGE)
         image = self.properties.get(self.IMAGE)
-        alias = self.properties.get(self.INSTANCE_ALIAS)
         user_script = self.properties.get(self.USER_SCRIPT)
 
-        ssh_keys = False
-        if not real_owner:
-            ssh_keys = []
-            try:
-                for key in self.nova().keypairs.list():
-                    ssh_keys.append(key.public_key)
-            except:
-                pass
-            if len(ssh_keys) == 0:
-                    ssh_keys = False
-
-        if alias:
-            # add stack id to avoid alias collisions
-            alias = alias + '-' + self.stack.id
-        if not alias:
-            alias = uuid.uuid4().__str__() + '-' + self.stack.id
-
         logger.debug(_("Trying to create a Machine with "
                        "owner: %s, "
                        "networks: %s, "
@@ -651,29 +2466,119 @@ class SDCKVM(SDCMachine):
                                         ssh_keys=ssh_keys)
         logger.debug(_("VM Created %s") % machine)
 
-        self.resource_id_set(machine.uuid)
+        return machine
 
-        return machine.uuid
 
+class SDCMachineGroup(SDCMachine):
 
-def resource_mapping():
-    cfg_parser = SafeConfigParser()
-    cfg_parser.read(SDC_CONFIG_FILE)
+    COUNT = 'count'
+    PROPERTIES = SDCMachine.PROPERTIES + (COUNT,)
+
+    properties_schema = dict(SDCMachine.properties_schema)
+    properties_schema.update({
+        COUNT: properties.Schema(
+            properties.Schema.INTEGER,
+            _('Number of machines in the group.'),
+            required=True,
+            constraints=[constraints.Range(min=1)]
+        )
+    })
+
+    attributes_schema = {
+        'uuids': _('uuids of all machines in the group'),
+        'network_ips': _('ip address of each machine'),
+        'external_ips': _('external ip addresses of each machine'),
+        'internal_ips': _('internal ip addresses of each machine'),
+        'ips_by_network': _('map of network uuid to the ip addresses of all machines in that network'),
+        'ips_by_tag': _('map of nic tag to the ip addresses of all machines with that nic tag')
+    }
 
-    enable_smartmachine = cfg_parser.get('RESOURCES', 'enable_smartmachine')
-    enable_kvm = cfg_parser.get('RESOURCES', 'enable_kvm')
-    enable_network = cfg_parser.get('RESOURCES', 'enable_network')
-    enable_smart_network = cfg_parser.get('RESOURCES', 'enable_smart_network')
+    def _vm_uuids(self):
+        members = self.data().get('members')
+        if not members:
+            return []
+        return members.split(',')
+
+    def _resolve_attribute(self, name):
+
+        if name == 'uuids':
+            return self._vm_uuids()
+        machines = self._get_machine_records(self._vm_uuids())
+        if name == 'network_ips':
+            return [machine.primary_ip if machine else None for machine in machines]
+        if name == 'external_ips':
+            return [self._nic_ips(machine, EXTERNAL_NIC_TAG) if machine else '' for machine in machines]
+        if name == 'internal_ips':
+            nic_tag = self._internal_nic_tag()
+            return [self._nic_ips(machine, nic_tag) if machine else '' for machine in machines]
+        if name in ('ips_by_network', 'ips_by_tag'):
+            merged = {}
+            for machine in machines:
+                if machine:
+                    for key, ips in getattr(machine, name).items():
+                        merged.setdefault(key, []).extend(ips)
+            return merged
+
+    def handle_create(self):
+
+        dc = self._get_dc()
+        self._prefetch_image(dc)
+
+        count = self.properties.get(self.COUNT)
+        ssh_keys = self._get_ssh_keys()
+        aliases = [self._get_alias('-%i' % index) for index in range(count)]
+        # the group and every member are recorded as soon as they exist, so deleting the group cleans them up
+        # even if this create fails or is cancelled half way
+        self.resource_id_set(self.physical_resource_name())
+        members = []
+        members_lock = threading.Lock()
+
+        def create(alias):
+            try:
+                machine = self._create_machine(dc, alias, ssh_keys)
+            except Exception as e:
+                logger.error(_("Creating group member %s failed: %s") % (alias, e))
+                return e
+            with members_lock:
+                members.append(machine.uuid)
+                self.data_set('members', ','.join(members))
+            return None
+
+        pool = eventlet.GreenPool(MACHINE_ACTION_CONCURRENCY)
+        errors = [error for error in pool.imap(admission_controller.bind(create), aliases) if error]
+
+        self.data_set('user_script_digest', user_script_digest(self.properties.get(self.USER_SCRIPT)))
+        self._watch(dc, 'create')
+        if errors:
+            raise errors[0]
+
+        return list(members)
+
+
+class SDCSmartMachineGroup(SDCMachineGroup, SDCSmartMachine):
+    pass
+
+
+class SDCKVMGroup(SDCMachineGroup, SDCKVM):
+    pass
+
+
+def resource_mapping():
+    cfg = get_config()
 
     mappings = {}
 
-    if enable_smartmachine == 'True':
+    if cfg.enable_smartmachine:
         mappings['SDC::Compute::SmartMachine'] = SDCSmartMachine
-    if enable_kvm == 'True':
+    if cfg.enable_kvm:
         mappings['SDC::Compute::KVM'] = SDCKVM
-    if enable_network == 'True':
+    if cfg.enable_network:
         mappings['SDC::Network::Network'] = SDCNetwork
-    if enable_smart_network == 'True':
+    if cfg.enable_smart_network:
         mappings['SDC::Network::SmartNetwork'] = SDCSmartNetwork
+    if cfg.enable_smartmachine_group:
+        mappings['SDC::Compute::SmartMachineGroup'] = SDCSmartMachineGroup
+    if cfg.enable_kvm_group:
+        mappings['SDC::Compute::KVMGroup'] = SDCKVMGroup
 
-    return mappings
\ No newline at end of file
+    return mappings
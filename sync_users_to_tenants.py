@@ -7,20 +7,114 @@ Simple script that syncs users and tenants
 __author__ = 'ernm'
 
 from keystoneclient.v2_0 import client
-from keystoneclient.openstack.common.apiclient.exceptions import AuthorizationFailure
+from keystoneclient.openstack.common.apiclient.exceptions import AuthorizationFailure, Conflict, ConnectionRefused, \
+    HttpServerError, NotFound, RequestTimeout
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 import argparse
+import json
 import os
+import signal
+import sys
+import threading
+import time
 
 ROLE_NAMES_TO_GRANT = ['_member_', 'heat_stack_owner']
 USER_NAMES_TO_IGNORE = ['admin', 'heat', 'keystone']
 
+# number of users synced concurrently
+DEFAULT_WORKERS = 8
+# keystone calls failing with one of these errors are retried with exponential backoff
+TRANSIENT_ERRORS = (ConnectionRefused, HttpServerError, RequestTimeout)
+MAX_RETRIES = 3
+RETRY_DELAY = 0.5
+# seconds between two progress reports
+PROGRESS_INTERVAL = 10
+
+# number of plan actions applied per batch
+DEFAULT_BATCH_SIZE = 100
+# plan actions are applied kind by kind in this order, tenants have to exist before roles are granted in them
+ACTION_ORDER = ['create_tenant', 'grant_role', 'disable_tenant', 'revoke_role']
+
+# incremental sync settings
+DEFAULT_STATE_FILE = os.path.expanduser('~/.sync_users_to_tenants.json')
+# seconds after which an incremental run does a full reconciliation
+DEFAULT_FULL_SYNC_INTERVAL = 3600
+
+# daemon settings
+# seconds between two syncs of the daemon
+DEFAULT_DAEMON_INTERVAL = 10
+# seconds between two checks of the trigger file
+TRIGGER_POLL_INTERVAL = 1
+
+output_lock = threading.Lock()
+# messages go to stderr while the plan is written to stdout
+log_stream = sys.stdout
+
+
+def log(message):
+    '''
+    prints a message, workers use this to not interleave their output
+    :param message: message
+    '''
+    with output_lock:
+        print >> log_stream, message
+
 
-def get_client():
+def call_with_retries(func, *args, **kwargs):
+    '''
+    calls func and retries it on transient keystone errors
+    :param func: function to call
+    :return: return value of func
+    '''
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            log('## transient error %s, retrying in %.1fs' % (e, delay))
+            time.sleep(delay)
+
+
+class SyncProgress(object):
+    '''
+    counts processed users or actions and reports progress and throughput
     '''
-    creates keystone client
 
-    read env-vars and cli arguments and constructs keystone client
-    :return: keystone client
+    def __init__(self, total, unit='users', verb='synced', interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.unit = unit
+        self.verb = verb
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.started = time.time()
+        self.reported = self.started
+        self._lock = threading.Lock()
+
+    def item_done(self, failed=False):
+        with self._lock:
+            self.done += 1
+            if failed:
+                self.failed += 1
+            now = time.time()
+            if now - self.reported < self.interval:
+                return
+            self.reported = now
+        self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        log('# progress: %i/%i %s %s (%i failed), %.1f %s/s' %
+            (self.done, self.total, self.unit, self.verb, self.failed, self.done / elapsed, self.unit))
+
+
+def parse_args():
+    '''
+    parses the cli arguments, env-vars are used as defaults
+    :return: arguments
     '''
     token = os.environ.get('OS_SERVICE_TOKEN') or os.environ.get('SERVICE_TOKEN')
     endpoint = os.environ.get('OS_SERVICE_ENDPOINT') or os.environ.get('SERVICE_ENDPOINT')
@@ -38,6 +132,45 @@ def get_client():
                              'Defaults to env[OS_SERVICE_TOKEN].',
                         default=endpoint,
                         dest='endpoint')
+    parser.add_argument('--workers',
+                        help='Number of users synced concurrently. Defaults to %i.' % DEFAULT_WORKERS,
+                        type=int,
+                        default=DEFAULT_WORKERS)
+    parser.add_argument('--apply-workers',
+                        help='Number of plan actions applied concurrently. Defaults to --workers.',
+                        type=int)
+    parser.add_argument('--batch-size',
+                        help='Number of plan actions applied per batch. Defaults to %i.' % DEFAULT_BATCH_SIZE,
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--plan',
+                        help='Only write the planned actions as json to this file (- for stdout), '
+                             'do not change anything.',
+                        nargs='?',
+                        const='-')
+    parser.add_argument('--incremental',
+                        help='Only sync users whose enabled flag, tenant or roles changed since the last run, '
+                             'according to the state file.',
+                        action='store_true')
+    parser.add_argument('--state-file',
+                        help='File the state of the last --incremental run is kept in. Defaults to %s.' %
+                             DEFAULT_STATE_FILE,
+                        default=DEFAULT_STATE_FILE)
+    parser.add_argument('--daemon',
+                        help='Keep running and sync incrementally every --interval seconds, on SIGHUP/SIGUSR1 '
+                             'or when --trigger-file is touched.',
+                        action='store_true')
+    parser.add_argument('--interval',
+                        help='Seconds between two syncs in daemon mode. Defaults to %i.' % DEFAULT_DAEMON_INTERVAL,
+                        type=float,
+                        default=DEFAULT_DAEMON_INTERVAL)
+    parser.add_argument('--trigger-file',
+                        help='In daemon mode, sync as soon as this file is created or touched.')
+    parser.add_argument('--full-sync-interval',
+                        help='Seconds after which an incremental run syncs all users. '
+                             'Defaults to %i.' % DEFAULT_FULL_SYNC_INTERVAL,
+                        type=int,
+                        default=DEFAULT_FULL_SYNC_INTERVAL)
 
     args = parser.parse_args()
 
@@ -45,6 +178,18 @@ def get_client():
     if not args.token or not args.endpoint:
         parser.print_help()
         exit(1)
+    return args
+
+
+def get_client(args=None):
+    '''
+    creates keystone client
+
+    read env-vars and cli arguments and constructs keystone client
+    :param args: parsed arguments, parsed from the cli if None
+    :return: keystone client
+    '''
+    args = args or parse_args()
 
     ks_client = client.Client(token=args.token, endpoint=args.endpoint)
     try:
@@ -61,7 +206,7 @@ def get_all_tenants(ks_client):
     :param ks_client: keystone client
     :return: list of tenants
     '''
-    return ks_client.tenants.list()
+    return call_with_retries(ks_client.tenants.list)
 
 
 def get_roles_to_grant(ks_client):
@@ -70,7 +215,7 @@ def get_roles_to_grant(ks_client):
     :param ks_client: keystone client
     :return: list of roles
     '''
-    roles_to_grant = [role for role in ks_client.roles.list() if role.name in ROLE_NAMES_TO_GRANT]
+    roles_to_grant = [role for role in call_with_retries(ks_client.roles.list) if role.name in ROLE_NAMES_TO_GRANT]
     assert len(ROLE_NAMES_TO_GRANT) == len(roles_to_grant), 'Unable to find all roles specified!'
     return roles_to_grant
 
@@ -81,105 +226,568 @@ def get_users_to_sync(ks_client):
     :param ks_client: keystone client
     :return: list of users
     '''
-    users_to_check = [user for user in ks_client.users.list()
+    users_to_check = [user for user in call_with_retries(ks_client.users.list)
                       if user.name not in USER_NAMES_TO_IGNORE]
     assert len(users_to_check) > 0, 'No users found to sync'
     return users_to_check
 
 
-def get_my_tenant(user, all_tenants):
+class TenantIndex(object):
     '''
-    returns tenant with the same name as the users
-    :param user: user
-    :param all_tenants: list of tenants
-    :return: tenant
+    index of tenants by name, tenants created during a sync are added to it
     '''
-    for tenant in all_tenants:
-        if user.name == tenant.name:
-            return tenant
 
+    def __init__(self, tenants=()):
+        self._tenants = dict((tenant.name, tenant) for tenant in tenants)
+        self._lock = threading.Lock()
 
-def create_tenant(ks_client, name):
+    def get(self, name):
+        return self._tenants.get(name)
+
+    def add(self, tenant):
+        with self._lock:
+            self._tenants[tenant.name] = tenant
+
+
+# result of comparing users with their tenants:
+# missing  - enabled users without a tenant
+# enabled  - (user, tenant) of enabled users with a tenant
+# disabled - (user, tenant) of disabled users that still have a tenant
+UserTenantDiff = namedtuple('UserTenantDiff', ['missing', 'enabled', 'disabled'])
+
+
+class SyncState(object):
+    '''
+    users, their tenants and roles as of the last sync, kept in a json file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.last_full_sync = 0
+        self.users = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''
+        reads the state file, an unreadable or corrupt file is logged and leads to a full sync
+        '''
+        if not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            last_full_sync = data.get('last_full_sync', 0)
+            users = data.get('users', {})
+        except (IOError, ValueError, AttributeError) as e:
+            log('# ignoring state file %s, doing a full sync: %s' % (self.path, e))
+            return self
+        self.last_full_sync = last_full_sync
+        self.users = users
+        return self
+
+    def save(self):
+        tmp_path = '%s.tmp' % self.path
+        with self._lock:
+            data = {'last_full_sync': self.last_full_sync, 'users': self.users}
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def needs_full_sync(self, interval):
+        return time.time() - self.last_full_sync >= interval
+
+    def record(self, user, tenant, roles):
+        '''
+        remembers the state a user was synced to
+        :param user: user
+        :param tenant: tenant of the user or None
+        :param roles: roles the user has in its tenant
+        '''
+        with self._lock:
+            self.users[user.id] = {'name': user.name,
+                                   'enabled': user.enabled,
+                                   'tenant_id': tenant.id if tenant else None,
+                                   'tenant_enabled': tenant.enabled if tenant else None,
+                                   'roles': sorted(role.id for role in roles)}
+
+    def forget(self, user_id):
+        with self._lock:
+            self.users.pop(user_id, None)
+
+    def prune(self, users):
+        '''
+        drops users that no longer exist
+        :param users: list of all users
+        '''
+        user_ids = set(user.id for user in users)
+        with self._lock:
+            for user_id in [user_id for user_id in self.users if user_id not in user_ids]:
+                del self.users[user_id]
+
+    def changed_users(self, users, tenant_index, roles_to_grant):
+        '''
+        returns users that changed since they were last synced
+        :param users: list of users
+        :param tenant_index: TenantIndex
+        :param roles_to_grant: roles enabled users get in their tenant
+        :return: list of users
+        '''
+        granted_role_ids = sorted(role.id for role in roles_to_grant)
+        changed = []
+        for user in users:
+            known = self.users.get(user.id)
+            tenant = tenant_index.get(user.name)
+            expected_roles = granted_role_ids if user.enabled == u'true' and tenant else []
+            if not known or known['name'] != user.name or known['enabled'] != user.enabled \
+                    or known['tenant_id'] != (tenant.id if tenant else None) \
+                    or known['tenant_enabled'] != (tenant.enabled if tenant else None) \
+                    or known['roles'] != expected_roles:
+                changed.append(user)
+        return changed
+
+
+def diff_users_to_tenants(users, tenant_index):
+    '''
+    compares users with their tenants, does not call keystone
+    :param users: list of users
+    :param tenant_index: TenantIndex
+    :return: UserTenantDiff
+    '''
+    diff = UserTenantDiff([], [], [])
+    for user in users:
+        my_tenant = tenant_index.get(user.name)
+        if user.enabled == u'true':
+            if my_tenant:
+                diff.enabled.append((user, my_tenant))
+            else:
+                diff.missing.append(user)
+        elif my_tenant:
+            diff.disabled.append((user, my_tenant))
+    return diff
+
+
+def find_tenant(ks_client, name):
+    '''
+    returns the tenant with the given name
+    :param ks_client: keystone client
+    :param name: name of the tenant
+    :return: tenant or None
+    '''
+    try:
+        return call_with_retries(ks_client.tenants.find, name=name)
+    except NotFound:
+        return None
+
+
+def create_tenant(ks_client, name, tenant_index=None):
     '''
     creates a new tenant
     :param ks_client: keystone client
     :param name: name of the new tenant
+    :param tenant_index: TenantIndex the new tenant is added to
     :return: tenant
     '''
-    print '## creating tenant %s' % name
-    my_tenant = ks_client.tenants.create(tenant_name=name, description='Tenant for user %s' % name,
-                                         enabled=True)
+    log('## creating tenant %s' % name)
+    # creates are not idempotent, after an error the tenant may exist anyway and is looked up instead
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            my_tenant = ks_client.tenants.create(tenant_name=name, description='Tenant for user %s' % name,
+                                                 enabled=True)
+            break
+        except Conflict:
+            my_tenant = find_tenant(ks_client, name)
+            if my_tenant is None:
+                raise
+            break
+        except TRANSIENT_ERRORS as e:
+            my_tenant = find_tenant(ks_client, name)
+            if my_tenant is not None:
+                break
+            if attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            log('## transient error %s, retrying in %.1fs' % (e, delay))
+            time.sleep(delay)
+    if tenant_index is not None:
+        tenant_index.add(my_tenant)
     return my_tenant
 
 
-def grant_roles_to_user(ks_client, roles, user, tenant):
+def get_existing_roles(ks_client, user, tenant):
+    '''
+    returns the roles a user has in a tenant
+    :param ks_client: keystone client
+    :param user: user
+    :param tenant: tenant
+    :return: list of roles
+    '''
+    return call_with_retries(ks_client.roles.roles_for_user, user=user, tenant=tenant)
+
+
+def grant_roles_to_user(ks_client, roles, user, tenant, existing_roles=None):
     '''
     grants a list of roles to a user for a tenant
     :param ks_client: keystone client
     :param roles: roles to grant
     :param user: user to grant roles to
     :param tenant: tenant to grant roles in
+    :param existing_roles: prefetched roles of the user in the tenant, fetched if None
     '''
-    existing_roles = ks_client.roles.roles_for_user(user=user, tenant=tenant)
+    if existing_roles is None:
+        existing_roles = get_existing_roles(ks_client, user, tenant)
                 # returns list of all roles which the user does not already have
     roles_to_grant = [role for role in roles if role not in existing_roles]
     for role in roles_to_grant:
-        print '## grant %s to user %s in tenant %s' % (role.name, user.name, tenant.name)
-        tenant.add_user(user=user, role=role)
+        log('## grant %s to user %s in tenant %s' % (role.name, user.name, tenant.name))
+        call_with_retries(tenant.add_user, user=user, role=role)
 
 
-def revoke_roles_from_user(ks_client, roles, user, tenant):
+def revoke_roles_from_user(ks_client, roles, user, tenant, existing_roles=None):
     '''
     revokes a list of roles from a user in a tenant
     :param ks_client: keystone client
     :param roles: roles to revoke
     :param user: user to revoke roles from
     :param tenant: tenant to revoke roles in
+    :param existing_roles: prefetched roles of the user in the tenant, fetched if None
     '''
-    existing_roles = ks_client.roles.roles_for_user(user=user, tenant=tenant)
+    if existing_roles is None:
+        existing_roles = get_existing_roles(ks_client, user, tenant)
     for role in [role for role in roles if role in existing_roles]:
-        print '## revoke role %s from user %s in tenant %s' % (role.name, user.name, user.name)
-        resp, _ = tenant.remove_user(user, role)
+        log('## revoke role %s from user %s in tenant %s' % (role.name, user.name, user.name))
+        resp, _ = call_with_retries(tenant.remove_user, user, role)
         resp.raise_for_status()
 
 
-def disable_tenant(tenant):
+def disable_tenant(tenant, tenant_index=None):
     '''
     disables tenant
     :param tenant: tenant
+    :param tenant_index: TenantIndex the disabled tenant is updated in
     '''
-    print '## disable tenant %s' % tenant.name
-    tenant.update(enabled=False)
+    log('## disable tenant %s' % tenant.name)
+    disabled_tenant = call_with_retries(tenant.update, enabled=False)
+    if disabled_tenant is not None and tenant_index is not None:
+        tenant_index.add(disabled_tenant)
+
 
+# one change to keystone, tenant is None for grants in tenants that are created by the same plan
+SyncAction = namedtuple('SyncAction', ['kind', 'user', 'tenant', 'role'])
 
-def sync_users_to_tenants(ks_client):
+
+class SyncPlan(object):
     '''
-    syncs users to tenants
+    actions that sync users to tenants
+    '''
+
+    def __init__(self):
+        self.actions = dict((kind, []) for kind in ACTION_ORDER)
+        self.failed_users = {}
+        self._lock = threading.Lock()
+
+    def add(self, actions):
+        with self._lock:
+            for action in actions:
+                self.actions[action.kind].append(action)
+
+    def fail(self, user, error):
+        with self._lock:
+            self.failed_users[user.id] = error
+
+    def __len__(self):
+        return sum(len(actions) for actions in self.actions.values())
+
+    def to_json(self):
+        def describe(action):
+            return {'action': action.kind,
+                    'user': action.user.name,
+                    'user_id': action.user.id,
+                    'tenant': action.tenant.name if action.tenant else action.user.name,
+                    'tenant_id': action.tenant.id if action.tenant else None,
+                    'role': action.role.name if action.role else None,
+                    'role_id': action.role.id if action.role else None}
+        return {'summary': dict((kind, len(self.actions[kind])) for kind in ACTION_ORDER),
+                'actions': [describe(action) for kind in ACTION_ORDER for action in self.actions[kind]],
+                'failed_users': dict((user_id, str(error)) for user_id, error in self.failed_users.items())}
+
+
+def plan_user(ks_client, user, my_tenant, roles_to_grant):
+    '''
+    returns the actions that sync a single user to its tenant, only reads from keystone
     :param ks_client: keystone client
+    :param user: user
+    :param my_tenant: tenant of the user, None if it does not exist yet
+    :param roles_to_grant: roles the user gets in its tenant
+    :return: list of SyncActions
     '''
-    all_tenants = get_all_tenants(ks_client=ks_client)
-    roles_to_grant = get_roles_to_grant(ks_client=ks_client)
-    users_to_sync = get_users_to_sync(ks_client=ks_client)
+    if user.enabled == u'true':
+        if not my_tenant:
+            return [SyncAction('create_tenant', user, None, None)] + \
+                [SyncAction('grant_role', user, None, role) for role in roles_to_grant]
+        existing_roles = get_existing_roles(ks_client, user, my_tenant)
+        return [SyncAction('grant_role', user, my_tenant, role) for role in roles_to_grant
+                if role not in existing_roles]
+
+    actions = []
+    if my_tenant:
+        if my_tenant.enabled:
+            actions.append(SyncAction('disable_tenant', user, my_tenant, None))
+        existing_roles = get_existing_roles(ks_client, user, my_tenant)
+        actions.extend(SyncAction('revoke_role', user, my_tenant, role) for role in roles_to_grant
+                       if role in existing_roles)
+    return actions
+
+
+def plan_sync(ks_client, diff, roles_to_grant, workers=DEFAULT_WORKERS):
+    '''
+    plans the actions for the users in a diff, role lookups run concurrently
+    :param ks_client: keystone client
+    :param diff: UserTenantDiff
+    :param roles_to_grant: roles enabled users get in their tenant
+    :param workers: number of concurrent lookups
+    :return: SyncPlan
+    '''
+    plan = SyncPlan()
+    # disabled users without a tenant need nothing
+    work = [(user, None) for user in diff.missing] + diff.enabled + diff.disabled
+    progress = SyncProgress(len(work), unit='users', verb='planned')
+
+    def plan_entry(entry):
+        user, my_tenant = entry
+        try:
+            plan.add(plan_user(ks_client, user, my_tenant, roles_to_grant))
+            progress.item_done()
+        except Exception as e:
+            log('# planning user %s failed: %s' % (user.name, e))
+            plan.fail(user, e)
+            progress.item_done(failed=True)
+
+    pool = ThreadPool(workers)
+    try:
+        pool.map(plan_entry, work)
+    finally:
+        pool.close()
+        pool.join()
+    progress.report()
+    return plan
 
-    for user in users_to_sync:
 
-        print '# syncing user %s' % user.name
+def apply_action(ks_client, action, tenant_index):
+    '''
+    applies a single SyncAction
+    :param ks_client: keystone client
+    :param action: SyncAction
+    :param tenant_index: TenantIndex, created tenants are added to it and grants look up new tenants in it
+    '''
+    if action.kind == 'create_tenant':
+        create_tenant(ks_client=ks_client, name=action.user.name, tenant_index=tenant_index)
+    elif action.kind == 'grant_role':
+        tenant = action.tenant or tenant_index.get(action.user.name)
+        grant_roles_to_user(ks_client=ks_client, roles=[action.role], user=action.user, tenant=tenant,
+                            existing_roles=[])
+    elif action.kind == 'disable_tenant':
+        disable_tenant(action.tenant, tenant_index=tenant_index)
+    elif action.kind == 'revoke_role':
+        revoke_roles_from_user(ks_client=ks_client, roles=[action.role], user=action.user, tenant=action.tenant,
+                               existing_roles=[action.role])
+
+
+def execute_plan(ks_client, plan, tenant_index, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    applies a plan kind by kind in batches, the actions of a batch are applied concurrently
 
-        my_tenant = get_my_tenant(user, all_tenants)
+    once an action of a user failed, the remaining actions of the user are skipped
+    :param ks_client: keystone client
+    :param plan: SyncPlan
+    :param tenant_index: TenantIndex
+    :param workers: number of actions applied concurrently
+    :param batch_size: number of actions per batch
+    '''
+    progress = SyncProgress(len(plan), unit='actions', verb='applied')
+
+    def apply_entry(action):
+        if action.user.id in plan.failed_users:
+            progress.item_done(failed=True)
+            return
+        try:
+            apply_action(ks_client, action, tenant_index)
+            progress.item_done()
+        except Exception as e:
+            log('# %s for user %s failed: %s' % (action.kind, action.user.name, e))
+            plan.fail(action.user, e)
+            progress.item_done(failed=True)
+
+    pool = ThreadPool(workers)
+    try:
+        for kind in ACTION_ORDER:
+            actions = plan.actions[kind]
+            for start in range(0, len(actions), batch_size):
+                pool.map(apply_entry, actions[start:start + batch_size])
+    finally:
+        pool.close()
+        pool.join()
+    progress.report()
+
+
+def sync_users_to_tenants(ks_client, workers=DEFAULT_WORKERS, state=None, incremental=False,
+                          full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL, apply_workers=None,
+                          batch_size=DEFAULT_BATCH_SIZE, dry_run=False, tenant_index=None, roles_to_grant=None):
+    '''
+    syncs users to tenants
+    :param ks_client: keystone client
+    :param workers: number of concurrent keystone lookups while planning
+    :param state: SyncState of incremental syncs, updated with the synced users
+    :param incremental: only sync users that changed according to state, without it state is not used
+    :param full_sync_interval: seconds after which an incremental sync syncs all users
+    :param apply_workers: number of actions applied concurrently, defaults to workers
+    :param batch_size: number of actions applied per batch
+    :param dry_run: only plan, do not change keystone or state
+    :param tenant_index: TenantIndex to use instead of listing all tenants
+    :param roles_to_grant: roles to grant instead of looking them up
+    :return: SyncPlan
+    '''
+    started = time.time()
+    if tenant_index is None:
+        tenant_index = TenantIndex(get_all_tenants(ks_client=ks_client))
+    if roles_to_grant is None:
+        roles_to_grant = get_roles_to_grant(ks_client=ks_client)
+    users_to_sync = get_users_to_sync(ks_client=ks_client)
 
-        if user.enabled == u'true':
-            if not my_tenant:
-                my_tenant = create_tenant(ks_client=ks_client, name=user.name)
-            grant_roles_to_user(ks_client=ks_client, roles=roles_to_grant, user=user,
-                                tenant=my_tenant)
+    if not incremental:
+        state = None
+    full_sync = state is None or state.needs_full_sync(full_sync_interval)
+    if not full_sync:
+        all_users = users_to_sync
+        users_to_sync = state.changed_users(all_users, tenant_index, roles_to_grant)
+        log('# incremental sync: %i of %i users changed' % (len(users_to_sync), len(all_users)))
+
+    diff = diff_users_to_tenants(users_to_sync, tenant_index)
+    plan = plan_sync(ks_client, diff, roles_to_grant, workers=workers)
+    if dry_run:
+        return plan
+
+    execute_plan(ks_client, plan, tenant_index, workers=apply_workers or workers, batch_size=batch_size)
+
+    if state is not None:
+        if full_sync:
+            state.prune(users_to_sync)
+        for user in users_to_sync:
+            if user.id in plan.failed_users:
+                # synced again by the next run
+                state.forget(user.id)
+                continue
+            my_tenant = tenant_index.get(user.name)
+            state.record(user, my_tenant, roles_to_grant if user.enabled == u'true' and my_tenant else [])
+        if full_sync:
+            state.last_full_sync = started
+        state.save()
+    return plan
+
+
+class SyncDaemon(object):
+    '''
+    syncs incrementally with one keystone client until stopped
 
-        else:
-            if my_tenant:
-                if my_tenant.enabled:
-                    disable_tenant(my_tenant)
-                revoke_roles_from_user(ks_client=ks_client, roles=roles_to_grant,
-                                       user=user, tenant=my_tenant)
+    tenants and roles are kept in memory between syncs and only listed again on full syncs, new users are picked
+    up by the next timer, signal or trigger file sync
+    '''
+
+    def __init__(self, ks_client, state, interval=DEFAULT_DAEMON_INTERVAL, trigger_file=None,
+                 full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL, **sync_options):
+        self.ks_client = ks_client
+        self.state = state
+        self.interval = interval
+        self.trigger_file = trigger_file
+        self.full_sync_interval = full_sync_interval
+        self.sync_options = sync_options
+        self.tenant_index = None
+        self.roles_to_grant = None
+        self._triggered = threading.Event()
+        self._stopped = False
+        self._trigger_mtime = self._get_trigger_mtime()
+
+    def _get_trigger_mtime(self):
+        if not self.trigger_file:
+            return None
+        try:
+            return os.stat(self.trigger_file).st_mtime
+        except OSError:
+            return None
+
+    def trigger(self, *args):
+        self._triggered.set()
+
+    def stop(self, *args):
+        self._stopped = True
+        self._triggered.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGHUP, self.trigger)
+        signal.signal(signal.SIGUSR1, self.trigger)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def sync_once(self):
+        if self.tenant_index is None or self.state.needs_full_sync(self.full_sync_interval):
+            self.tenant_index = TenantIndex(get_all_tenants(ks_client=self.ks_client))
+            self.roles_to_grant = get_roles_to_grant(ks_client=self.ks_client)
+        sync_users_to_tenants(self.ks_client, state=self.state, incremental=True,
+                              full_sync_interval=self.full_sync_interval, tenant_index=self.tenant_index,
+                              roles_to_grant=self.roles_to_grant, **self.sync_options)
+
+    def wait(self):
+        '''
+        waits until the interval passed, a signal arrived or the trigger file changed
+        '''
+        deadline = time.time() + self.interval
+        while not self._stopped:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            # a plain wait() can not be interrupted by signals
+            self._triggered.wait(min(remaining, TRIGGER_POLL_INTERVAL))
+            if self._triggered.is_set():
+                self._triggered.clear()
+                return
+            trigger_mtime = self._get_trigger_mtime()
+            if trigger_mtime != self._trigger_mtime:
+                self._trigger_mtime = trigger_mtime
+                if trigger_mtime is not None:
+                    return
+
+    def run(self):
+        log('# sync daemon started, interval %.1fs' % self.interval)
+        while not self._stopped:
+            try:
+                self.sync_once()
+            except Exception as e:
+                log('# sync failed: %s' % e)
+                # list everything again after errors
+                self.tenant_index = None
+            self.wait()
+        log('# sync daemon stopped')
 
 
 if __name__ == "__main__":
-    sync_users_to_tenants(get_client())
+    arguments = parse_args()
+    if arguments.daemon:
+        daemon = SyncDaemon(get_client(arguments), SyncState(arguments.state_file).load(),
+                            interval=arguments.interval, trigger_file=arguments.trigger_file,
+                            full_sync_interval=arguments.full_sync_interval, workers=arguments.workers,
+                            apply_workers=arguments.apply_workers, batch_size=arguments.batch_size)
+        daemon.install_signal_handlers()
+        daemon.run()
+        exit(0)
+    if arguments.plan == '-':
+        log_stream = sys.stderr
+    sync_plan = sync_users_to_tenants(get_client(arguments), workers=arguments.workers,
+                                      state=SyncState(arguments.state_file).load() if arguments.incremental else None,
+                                      incremental=arguments.incremental,
+                                      full_sync_interval=arguments.full_sync_interval,
+                                      apply_workers=arguments.apply_workers, batch_size=arguments.batch_size,
+                                      dry_run=arguments.plan is not None)
+    if arguments.plan == '-':
+        json.dump(sync_plan.to_json(), sys.stdout, indent=2)
+    elif arguments.plan:
+        with open(arguments.plan, 'w') as plan_file:
+            json.dump(sync_plan.to_json(), plan_file, indent=2)
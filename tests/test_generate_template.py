@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate_template import generate_template, validate_spec
+
+IMAGE_UUID = '62f148f8-6e84-11e4-82c5-efca60348b9f'
+PACKAGE_UUID = 'b1abec1a-80e5-ea9e-e091-8f2d67feb252'
+
+
+def machine_group(**group):
+    group.setdefault('image', IMAGE_UUID)
+    group.setdefault('package', PACKAGE_UUID)
+    return group
+
+
+def render(spec):
+    return yaml.safe_load('\n'.join(generate_template(spec)) + '\n')
+
+
+class ValidateSpecTest(unittest.TestCase):
+
+    def assertInvalid(self, spec, message):
+        with self.assertRaises(ValueError) as raised:
+            validate_spec(spec)
+        self.assertIn(message, str(raised.exception))
+
+    def test_valid_spec(self):
+        validate_spec({'networks': {'count': 2},
+                       'machines': [machine_group(name='web', count=3, networks=[2]),
+                                    machine_group(type='kvm_group', name='db', group_size=3)]})
+
+    def test_duplicate_group_name(self):
+        self.assertInvalid({'machines': [machine_group(name='web'), machine_group(name='web')]},
+                           'name web is already used')
+
+    def test_network_index_out_of_range(self):
+        self.assertInvalid({'networks': {'count': 2}, 'machines': [machine_group(name='web', networks=[3])]},
+                           'network 3 does not exist')
+
+    def test_group_type_without_group_size(self):
+        for group_type in ('smartmachine_group', 'kvm_group'):
+            self.assertInvalid({'machines': [machine_group(type=group_type)]}, 'needs a positive integer group_size')
+
+    def test_group_type_with_invalid_group_size(self):
+        for group_size in (0, -1, '3', True):
+            self.assertInvalid({'machines': [machine_group(type='kvm_group', group_size=group_size)]},
+                               'needs a positive integer group_size')
+
+    def test_group_size_on_single_machine(self):
+        for group_type in ('smartmachine', 'kvm'):
+            self.assertInvalid({'machines': [machine_group(type=group_type, group_size=3)]},
+                               'group_size is only allowed for')
+
+    def test_template_is_not_started_for_invalid_spec(self):
+        lines = generate_template({'machines': [machine_group(type='kvm', group_size=3)]})
+        self.assertRaises(ValueError, next, lines)
+
+
+class GenerateTemplateTest(unittest.TestCase):
+
+    def test_count_only_on_group_resources(self):
+        template = render({'machines': [machine_group(type='smartmachine_group', name='web', group_size=4),
+                                        machine_group(type='kvm', name='db')]})
+        self.assertEqual(template['resources']['web_1']['properties']['count'], 4)
+        self.assertNotIn('count', template['resources']['db_1']['properties'])
+
+    def test_user_script_is_kept_exactly(self):
+        for user_script in ('  echo indented\necho next\n', 'echo one\necho two\n\n', 'touch /test'):
+            template = render({'user_script': user_script, 'machines': [machine_group()]})
+            self.assertEqual(template['parameters']['user_script']['default'], user_script)
+
+    def test_user_script_template_is_kept_exactly(self):
+        user_script = '  cd /srv\necho %instance_alias%\n'
+        template = render({'user_script_template': user_script, 'machines': [machine_group()]})
+        self.assertEqual(template['parameters']['user_script_template']['default'], user_script)
+
+    def test_machines_reference_networks(self):
+        template = render({'networks': {'count': 2}, 'external_networks': ['ext'],
+                           'machines': [machine_group(name='web', networks=[2])]})
+        self.assertIn('net_2', template['resources'])
+        networks = template['resources']['web_1']['properties']['networks']['Fn::Join'][1]
+        self.assertEqual(networks, [{'get_param': 'external_networks'}, {'get_attr': ['net_2', 'uuid']}])
+
+
+if __name__ == '__main__':
+    unittest.main()